@@ -0,0 +1,299 @@
+import bisect
+import csv
+import heapq
+import io
+import os
+import queue
+import threading
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: only one process writes, threads are still serialized
+    fcntl = None
+
+FIELDS = ('user_id', 'date', 'time', 'status')
+
+# AttendanceWriter defaults
+WRITE_QUEUE_SIZE = 10000
+FLUSH_INTERVAL = 1.0   # seconds between batched writes
+FLUSH_BATCH_SIZE = 500
+
+
+class AttendanceStore:
+    """Append-only attendance CSV with an in-memory (name, date) index.
+
+    The file is read once; afterwards only bytes appended since the last sync are
+    parsed, so duplicate checks cost O(1) no matter how much history the CSV holds.
+    Rows appended by other processes are picked up on the next sync. Appends
+    hold an exclusive lock on the CSV and re-check the index under it, so
+    processes sharing the file neither interleave rows nor write a duplicate.
+
+    Records are also indexed by user and by date (as ascending row numbers), so
+    `query()` only touches the rows that can match its filters.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.marked = set()  # (name, date) in the file
+        self.claimed = set()  # (name, date) queued by an AttendanceWriter, not yet in the file
+        self.records = []    # (user_id, date, time, status) in file order
+        self.by_user = {}    # user_id -> row numbers
+        self.by_date = {}    # date -> row numbers
+        self.offset = 0      # bytes of the file already indexed
+        self.lock = threading.Lock()
+
+    def _reset(self):
+        self.marked.clear()
+        self.records.clear()
+        self.by_user.clear()
+        self.by_date.clear()
+        self.offset = 0
+
+    def _index_row(self, row):
+        if len(row) >= 4:
+            record = tuple(row[:4])
+            row_number = len(self.records)
+            self.records.append(record)
+            self.marked.add((record[0], record[1]))
+            self.by_user.setdefault(record[0], []).append(row_number)
+            self.by_date.setdefault(record[1], []).append(row_number)
+
+    def _sync(self):
+        """Index rows appended to the file since the last sync (caller holds the lock)"""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size < self.offset:
+            # The file was truncated or replaced, start over
+            self._reset()
+        if size == self.offset:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        # Leave a partially written last line for the next sync
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return
+        for row in csv.reader(io.StringIO(data[:end].decode('utf-8'))):
+            self._index_row(row)
+        self.offset += end
+
+    def _append(self, rows, fsync=False):
+        """Append the rows not yet recorded for their day, return those written (caller holds the lock)"""
+        with open(self.path, 'a', newline='') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # Another process may have recorded the same (name, date) since our last sync
+                self._sync()
+                fresh, keys = [], set()
+                for row in rows:
+                    key = (row[0], row[1])
+                    if key not in self.marked and key not in keys:
+                        keys.add(key)
+                        fresh.append(row)
+                csv.writer(f).writerows(fresh)
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+                self.marked |= keys
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        # The rows are added to the full index by the next sync
+        return fresh
+
+    def is_marked(self, name, date_str):
+        """Whether attendance is already recorded (or queued) for name on date_str"""
+        with self.lock:
+            self._sync()
+            return (name, date_str) in self.marked or (name, date_str) in self.claimed
+
+    def mark(self, name, status='Present', when=None):
+        """Record attendance unless it is already recorded for that day, return True if written"""
+        when = when or datetime.now()
+        date_str = when.strftime('%Y-%m-%d')
+        time_str = when.strftime('%H:%M:%S')
+        with self.lock:
+            self._sync()
+            if (name, date_str) in self.marked or (name, date_str) in self.claimed:
+                return False
+            return bool(self._append([[name, date_str, time_str, status]]))
+
+    def _candidates(self, user_id, date_from, date_to):
+        """Ascending row numbers that can match the user and date filters (caller holds the lock)"""
+        if user_id is not None:
+            return self.by_user.get(user_id, [])
+        if date_from is None and date_to is None:
+            return range(len(self.records))
+        dates = [d for d in self.by_date
+                 if (date_from is None or d >= date_from) and (date_to is None or d <= date_to)]
+        return list(heapq.merge(*(self.by_date[d] for d in dates)))
+
+    def query(self, user_id=None, date_from=None, date_to=None, status=None, cursor=0, limit=100):
+        """Return (records, next_cursor) for one page of matching rows in file order.
+
+        Dates are inclusive `YYYY-MM-DD` strings. `cursor` is the row number to
+        resume from; next_cursor is None once there are no more rows.
+        """
+        status = status.lower() if status else None
+        page = []
+        with self.lock:
+            self._sync()
+            candidates = self._candidates(user_id, date_from, date_to)
+            start = bisect.bisect_left(candidates, cursor)
+            for i in range(start, len(candidates)):
+                record = self.records[candidates[i]]
+                if date_from is not None and record[1] < date_from:
+                    continue
+                if date_to is not None and record[1] > date_to:
+                    continue
+                if status is not None and record[3].lower() != status:
+                    continue
+                if len(page) == limit:
+                    return page, candidates[i]
+                page.append(dict(zip(FIELDS, record)))
+        return page, None
+
+    def iter_rows(self, user_id=None, date_from=None, date_to=None, status=None):
+        """Stream matching rows straight from the CSV without holding them in memory"""
+        status = status.lower() if status else None
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 4:
+                    continue
+                if user_id is not None and row[0] != user_id:
+                    continue
+                if date_from is not None and row[1] < date_from:
+                    continue
+                if date_to is not None and row[1] > date_to:
+                    continue
+                if status is not None and row[3].lower() != status:
+                    continue
+                yield dict(zip(FIELDS, row[:4]))
+
+
+class AttendanceWriter:
+    """Moves attendance writes off the request and render threads.
+
+    `mark()` checks the store's in-memory (name, date) index, claims the slot and
+    queues the row; a background thread appends queued rows in batches and fsyncs
+    once per batch. Appends go through the store's locks, so neither threads nor
+    processes interleave partial rows, and a row another process recorded in the
+    meantime is dropped. If a write fails its claims are released, so the next
+    mark() for that day tries again. When the queue is full the caller writes
+    the row itself rather than dropping it.
+
+    Queued rows reach the file (and `store.query()`) within `flush_interval`;
+    call `flush()` first where a read must see them. `close()` drains the queue
+    and is registered with atexit by the services.
+    """
+
+    def __init__(self, store, max_queue=WRITE_QUEUE_SIZE, flush_interval=FLUSH_INTERVAL,
+                 batch_size=FLUSH_BATCH_SIZE):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+        self.wake = threading.Event()
+        self.written = 0
+        self.batches = 0
+        self.thread = threading.Thread(target=self._run, name='attendance-writer', daemon=True)
+        self.thread.start()
+
+    def mark(self, name, status='Present', when=None):
+        """Queue attendance unless it is already recorded for that day, return True if queued"""
+        when = when or datetime.now()
+        row = [name, when.strftime('%Y-%m-%d'), when.strftime('%H:%M:%S'), status]
+        store = self.store
+        with store.lock:
+            store._sync()
+            if (row[0], row[1]) in store.marked or (row[0], row[1]) in store.claimed:
+                return False
+            store.claimed.add((row[0], row[1]))
+        if self.closed:
+            self._write([row])
+            return True
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            self._write([row])
+        return True
+
+    def _write(self, rows):
+        with self.store.lock:
+            try:
+                written = self.store._append(rows, fsync=True)
+            finally:
+                # Written rows are in the index now; failed ones may be marked again
+                self.store.claimed.difference_update((row[0], row[1]) for row in rows)
+        self.written += len(written)
+        self.batches += 1
+
+    def _drain(self, first):
+        """Collect up to batch_size queued rows, stopping at the close sentinel"""
+        rows = [first]
+        while len(rows) < self.batch_size:
+            try:
+                row = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            rows.append(row)
+            if row is None:
+                break
+        return rows
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            if first is not None:
+                # Let a burst of marks accumulate into one write, unless flush() is waiting
+                self.wake.wait(self.flush_interval)
+            rows = self._drain(first)
+            stop = rows[-1] is None
+            batch = rows[:-1] if stop else rows
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception as e:
+                # _write() has released the rows' claims, so they can be marked again; keep the thread alive
+                # for the marks that follow, since nothing else would ever write them
+                print(f"Failed to write {len(batch)} attendance rows: {e!r}")
+            finally:
+                for _ in rows:
+                    self.queue.task_done()
+            if stop:
+                return
+
+    def flush(self):
+        """Write queued rows now and block until they are on disk"""
+        if self.thread.is_alive():
+            self.wake.set()
+            self.queue.join()
+            self.wake.clear()
+
+    def close(self):
+        """Write out the queue and stop the background thread"""
+        if self.closed:
+            return
+        self.closed = True
+        self.wake.set()
+        self.queue.put(None)
+        self.thread.join()
+        # Rows queued by a mark() that raced with close()
+        leftover = []
+        while True:
+            try:
+                row = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is not None:
+                leftover.append(row)
+        if leftover:
+            self._write(leftover)
@@ -0,0 +1,342 @@
+"""Production front end for the face verification service.
+
+Serves the same API as face_verify_service.py, but request parsing runs on an
+asyncio event loop and every image job (decode, detect, predict) runs in a pool
+of worker processes sized to the CPU count, so a burst of verifications never
+blocks /test or the loop itself. The workers share the memory-mapped template
+store, so adding processes does not multiply the gallery.
+
+    cd backend && python asgi_service.py
+    cd backend && uvicorn asgi_service:app --port 5000 --timeout-graceful-shutdown 30
+
+Requests beyond the queue limit get 429 with Retry-After, jobs that take longer
+than the timeout get 504, and on shutdown in-flight jobs finish before the
+workers exit. If a worker dies (a crash in OpenCV, the OOM killer) the pool is
+replaced and the jobs it took down get 503. /metrics merges the front end's request metrics with the stage
+metrics each worker sends back with its results.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+# Shared modules live in the repository root; backend/ goes first so that
+# `face_verify_service` is the backend service, not the root one
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from image_io import MULTIPART, OCTET_STREAM, parse_box_field
+from metrics import CONTENT_TYPE, REGISTRY, REJECTIONS, REQUEST_SECONDS, REQUESTS
+
+PORT = int(os.environ.get('FACE_SERVICE_PORT', 5000))
+POOL_WORKERS = int(os.environ.get('FACE_POOL_WORKERS', os.cpu_count() or 4))
+# Jobs queued or running at once; beyond this requests are turned away with 429
+MAX_PENDING = int(os.environ.get('FACE_MAX_PENDING', POOL_WORKERS * 4))
+REQUEST_TIMEOUT = float(os.environ.get('FACE_REQUEST_TIMEOUT', 15))
+SHUTDOWN_TIMEOUT = int(os.environ.get('FACE_SHUTDOWN_TIMEOUT', 30))
+MAX_BATCH_SIZE = 200  # same limit as face_verify_service.MAX_BATCH_SIZE
+
+pool = None
+pool_lock = threading.Lock()
+pending = 0
+shutting_down = False
+worker_metrics = {}  # worker pid -> metrics snapshot sent with its last result
+
+REGISTRY.gauge('face_pool_pending', 'Jobs queued or running in the worker pool').set_function(lambda: pending)
+
+
+def _init_worker():
+    # Ctrl+C reaches the whole process group; only the server decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Importing the service syncs the template store and warms the imports once per process
+    import face_verify_service  # noqa: F401
+
+
+def _run(job, *args):
+    import face_verify_service as service
+    from face_detection import FaceInputError
+    try:
+        return getattr(service, job)(*args)
+    except FaceInputError as e:
+        REJECTIONS.inc(reason='invalid_input')
+        return {'error': str(e)}, 400
+    except Exception as e:
+        print(f"Error in {job}: {str(e)}")
+        return {'error': str(e)}, 500
+
+
+def _call(job, *args):
+    """Run a face_verify_service function in a worker process.
+
+    Returns (result, worker pid, the worker's metrics snapshot); the snapshot is a
+    few kilobytes, so shipping it with every result keeps /metrics current
+    without a separate channel to the workers.
+    """
+    result = _run(job, *args)
+    return result, os.getpid(), REGISTRY.snapshot()
+
+
+def _release(_future):
+    global pending
+    pending -= 1
+
+
+def make_pool():
+    # spawn: forking a process that already runs an event loop and threads is unsafe
+    return ProcessPoolExecutor(max_workers=POOL_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker)
+
+
+def replace_pool(broken):
+    """Swap a pool whose worker died for a new one; the first failed job to notice replaces it"""
+    global pool
+    with pool_lock:
+        if pool is not broken or shutting_down:
+            return
+        pool = make_pool()
+    print("A face worker process died, restarted the worker pool")
+    broken.shutdown(wait=False)
+
+
+def busy_response():
+    REJECTIONS.inc(reason='busy')
+    return JSONResponse({'error': 'Face service is busy, retry shortly'}, 429, headers={'Retry-After': '1'})
+
+
+def admit(jobs=1):
+    """Reserve room for jobs in the pool queue, False when it is full or shutting down"""
+    global pending
+    if shutting_down or pending + jobs > MAX_PENDING:
+        return False
+    pending += jobs
+    return True
+
+
+async def submit(job, *args):
+    """Run an admitted job in the pool and wait for it, raising asyncio.TimeoutError or BrokenProcessPool"""
+    current = pool
+    try:
+        future = asyncio.get_running_loop().run_in_executor(current, _call, job, *args)
+    except BrokenProcessPool:
+        _release(None)
+        replace_pool(current)
+        raise
+    # The slot is freed when the job really finishes, not when the request gives up on it
+    future.add_done_callback(_release)
+    try:
+        result, pid, snapshot = await asyncio.wait_for(asyncio.shield(future), REQUEST_TIMEOUT)
+    except BrokenProcessPool:
+        replace_pool(current)
+        raise
+    worker_metrics[pid] = snapshot
+    return result
+
+
+def timeout_response():
+    REJECTIONS.inc(reason='timeout')
+    return JSONResponse({'error': 'Face processing timed out'}, 504)
+
+
+def crashed_response():
+    REJECTIONS.inc(reason='worker_crashed')
+    return JSONResponse({'error': 'Face worker stopped unexpectedly, retry shortly'}, 503,
+                        headers={'Retry-After': '1'})
+
+
+async def read_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+async def read_fields(request, image_fields):
+    """Async counterpart of image_io.request_fields(): JSON, multipart or octet-stream"""
+    content_type = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    if content_type == OCTET_STREAM:
+        fields = dict(request.query_params)
+        fields[image_fields[0]] = await request.body()
+    elif content_type == MULTIPART:
+        fields = {}
+        async with request.form() as form:
+            for name, value in form.multi_items():
+                if isinstance(value, UploadFile):
+                    if name in image_fields:
+                        fields[name] = await value.read()
+                else:
+                    fields[name] = value
+    else:
+        return await read_json(request)
+    if 'face_box' in fields:
+        fields['face_box'] = parse_box_field(fields['face_box'])
+    return fields
+
+
+async def run_job(request, job, fields, image_fields=()):
+    """Parse the body on the loop, then run job(*fields) in the pool"""
+    data = await read_fields(request, image_fields) if image_fields else await read_json(request)
+    if data is None:
+        return JSONResponse({'error': 'Invalid request body'}, 400)
+    if not admit():
+        return busy_response()
+    try:
+        body, status = await submit(job, *(data if f is None else data.get(f) for f in fields))
+    except asyncio.TimeoutError:
+        return timeout_response()
+    except BrokenProcessPool:
+        return crashed_response()
+    return JSONResponse(body, status)
+
+
+async def test(request):
+    return JSONResponse({
+        'status': 'ok',
+        'message': 'Server is running',
+        'workers': POOL_WORKERS,
+        'pending': pending,
+        'max_pending': MAX_PENDING,
+    })
+
+
+async def metrics(request):
+    return Response(REGISTRY.render(*worker_metrics.values()), media_type=CONTENT_TYPE)
+
+
+async def register_face(request):
+    return await run_job(request, 'register_student_face',
+                         ('studentId', 'image', 'face_box', 'face_image', 'class_group'), ('image', 'face_image'))
+
+
+async def verify_face(request):
+    return await run_job(request, 'verify_student',
+                         ('student_id', 'current_image', 'registered_image', 'face_box', 'face_image'),
+                         ('current_image', 'registered_image', 'face_image'))
+
+
+async def identify_faces(request):
+    return await run_job(request, 'identify_classroom', ('image', 'class_group', 'roster'), ('image',))
+
+
+async def identify(request):
+    # None passes the whole body through
+    return await run_job(request, 'identify_student', (None,), ('current_image', 'face_image'))
+
+
+async def class_group_roster(request):
+    class_group = request.path_params['class_group']
+    if request.method == 'GET':
+        job = ('class_roster', class_group)
+    else:
+        data = await read_json(request)
+        if data is None or 'student_ids' not in data:
+            return JSONResponse({'error': 'Missing student_ids'}, 400)
+        job = ('set_class_roster', class_group, data['student_ids'])
+    if not admit():
+        return busy_response()
+    try:
+        body, status = await submit(*job)
+    except asyncio.TimeoutError:
+        return timeout_response()
+    except BrokenProcessPool:
+        return crashed_response()
+    return JSONResponse(body, status)
+
+
+async def compact_gallery(request):
+    # A large gallery can take longer than the request timeout; the job still finishes in its worker
+    return await run_job(request, 'compact_samples', (None,))
+
+
+async def verify_batch(request):
+    data = await read_json(request)
+    items = data.get('items') if data else None
+    if not isinstance(items, list) or not items:
+        return JSONResponse({'error': 'Missing items'}, 400)
+    if len(items) > MAX_BATCH_SIZE:
+        return JSONResponse({'error': f'Too many items, at most {MAX_BATCH_SIZE} per batch'}, 413)
+    if not all(isinstance(item, dict) for item in items):
+        return JSONResponse({'error': 'Each item must be an object'}, 400)
+    # Every item is its own job. A batch reserves at most MAX_PENDING slots and feeds its
+    # items through them, so a class larger than the queue still fits on an idle server
+    slots = min(len(items), MAX_PENDING)
+    if not admit(slots):
+        return busy_response()
+    lanes = asyncio.Semaphore(slots)
+    started = 0
+
+    async def verify(item):
+        global pending
+        nonlocal started
+        async with lanes:
+            started += 1
+            if started > slots:
+                # The previous job in this lane finished and released its slot; take it back
+                pending += 1
+            return await submit('verify_batch_item', item)
+
+    tasks = [asyncio.ensure_future(verify(item)) for item in items]
+    try:
+        results = await asyncio.gather(*tasks)
+    except (asyncio.TimeoutError, BrokenProcessPool) as e:
+        # Items still waiting for a lane are never submitted; running jobs finish in the pool
+        for task in tasks:
+            task.cancel()
+        return timeout_response() if isinstance(e, asyncio.TimeoutError) else crashed_response()
+    return JSONResponse({
+        'success': True,
+        'verified': sum(1 for r in results if r['success']),
+        'results': results
+    })
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global pool, shutting_down
+    pool = make_pool()
+    print(f"Face service using {POOL_WORKERS} worker processes, queue limit {MAX_PENDING}")
+    try:
+        yield
+    finally:
+        shutting_down = True
+        # Uvicorn has already drained open requests; let queued jobs finish, then stop the workers
+        await asyncio.get_running_loop().run_in_executor(None, pool.shutdown, True)
+
+
+def route(path, endpoint, methods):
+    """Route that counts and times its requests like metrics.instrument_flask()"""
+    async def instrumented(request):
+        start = time.perf_counter()
+        response = await endpoint(request)
+        REQUESTS.inc(endpoint=path, status=response.status_code)
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=path)
+        return response
+    return Route(path, instrumented, methods=methods)
+
+
+app = Starlette(routes=[
+    route('/test', test, methods=['GET']),
+    route('/metrics', metrics, methods=['GET']),
+    route('/register-face', register_face, methods=['POST']),
+    route('/verify-face', verify_face, methods=['POST']),
+    route('/verify-batch', verify_batch, methods=['POST']),
+    route('/identify-faces', identify_faces, methods=['POST']),
+    route('/identify', identify, methods=['POST']),
+    route('/class-groups/{class_group}', class_group_roster, methods=['GET', 'PUT']),
+    route('/gallery/compact', compact_gallery, methods=['POST']),
+], lifespan=lifespan)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='127.0.0.1', port=PORT, timeout_graceful_shutdown=SHUTDOWN_TIMEOUT)
@@ -1,25 +1,84 @@
 import cv2
-import numpy as np
 import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import json
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 
+# Shared recognition modules live at the repository root
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from face_cache import RegisteredFaceCache, ResultCache, content_hash, request_key
+from face_compaction import MAX_SAMPLES_PER_STUDENT, compact_gallery
+from face_gallery import METRICS
+from face_quality import check_face, quality_error
+from face_shards import RosterStore, ShardCache, parse_id_list
+from template_store import TemplateStore
+from image_io import (decode_gray_for_faces, decode_gray_image, image_bytes, parse_flag, request_fields,
+                      scale_box)
+from face_detection import (CLASSROOM_DETECTION_WIDTH, CLASSROOM_MIN_FACE_RATIO, FaceInputError, crop_face,
+                            decode_face_crop, detect_classroom_faces, detect_faces, parse_face_box)
+from metrics import (CONFIDENCE, CONTENT_TYPE, GALLERY_SIZE, REGISTRY, REJECTIONS, STAGE_SECONDS,
+                     instrument_flask)
+
 app = Flask(__name__)
 CORS(app)
+instrument_flask(app)
 
 # Constants
 KNOWN_FACES_DIR = 'known_faces'
+MODEL_DIR = 'trained_model'
+TEMPLATE_STORE_DIR = os.path.join(MODEL_DIR, 'templates')
 FACE_SIZE = (200, 200)
 THRESHOLD = 60
+REGISTERED_CACHE_SIZE = 1024
+MAX_BATCH_SIZE = 200
+BATCH_WORKERS = os.cpu_count() or 4
+MAX_TOP_K = 50
+# Verdicts and rejections of the frame itself are cached; server errors are not
+CACHED_STATUSES = (200, 400)
+MAX_ROSTER_SIZE = 5000
+STUDENT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
 
 # Ensure directories exist
 os.makedirs(KNOWN_FACES_DIR, exist_ok=True)
 
-# Initialize face detector and recognizer
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-recognizer = cv2.face.LBPHFaceRecognizer_create()
+# Gallery histograms live in a memory-mapped store that every worker process shares;
+# detection goes through face_detection.detect_faces
+template_store = TemplateStore(TEMPLATE_STORE_DIR, KNOWN_FACES_DIR, face_size=FACE_SIZE)
+registered_faces = RegisteredFaceCache(REGISTERED_CACHE_SIZE)
+# Verdicts for frames that are resubmitted unchanged; the registered image hash is part of the key
+verify_results = ResultCache()
+# Class group rosters, recorded at registration, and the per-roster gallery shards cut from the store
+rosters = RosterStore(template_store)
+shards = ShardCache(template_store, rosters)
+
+# OpenCV releases the GIL while detecting and predicting, so batch items run on threads
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
+def current_gallery():
+    """The shared gallery, remapped when any worker enrolled or removed a face"""
+    return template_store.gallery()
+
+def search_gallery(class_group=None, roster=None):
+    """The gallery to identify against: a lecture roster, the shard of one or more class groups, or everyone.
+
+    An empty roster means no candidates, not everyone. Raises ValueError for a
+    malformed class_group or roster.
+    """
+    if class_group is None and roster is None:
+        return current_gallery()
+    student_ids = parse_id_list(roster)
+    if len(student_ids) > MAX_ROSTER_SIZE:
+        raise ValueError(f'roster has more than {MAX_ROSTER_SIZE} students')
+    return shards.gallery(parse_id_list(class_group), student_ids)
+
+# Only new or changed images are extracted; with several workers the first one to
+# get the store lock does the work and the rest find it up to date
+template_store.sync()
+GALLERY_SIZE.set_function(lambda: len(current_gallery()))
 
 @app.route('/test', methods=['GET'])
 def test():
@@ -30,159 +89,465 @@ def test():
         'dir_exists': os.path.exists(KNOWN_FACES_DIR)
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Request, stage latency and rejection metrics in the Prometheus text format"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 def train_recognizer():
-    """Train the face recognizer with all registered faces"""
-    faces = []
-    labels = []
-    label_map = {}
-    
-    for idx, filename in enumerate(os.listdir(KNOWN_FACES_DIR)):
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-            path = os.path.join(KNOWN_FACES_DIR, filename)
-            img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
-            if img is None:
-                continue
-            faces.append(cv2.resize(img, FACE_SIZE))
-            labels.append(idx)
-            label_map[idx] = os.path.splitext(filename)[0].split('_')[0]
-    
-    if len(faces) > 0:
-        recognizer.train(faces, np.array(labels))
-        print(f"Recognizer trained with {len(faces)} faces")
-    return label_map
+    """Rebuild the template store from every registered face"""
+    return template_store.sync(rebuild=True)
+
+def registered_image_bytes(student_id):
+    """Read the registered image the Node server stored for a student, or None"""
+    if not STUDENT_ID_PATTERN.match(student_id):
+        return None
+    path = os.path.join(KNOWN_FACES_DIR, f'{student_id}.jpg')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+def register_student_face(student_id, image_data, face_box=None, face_image=None, class_group=None):
+    """Save a student's face sample and add it to the template store, returning (body, status)"""
+    if not (image_data or face_image) or not student_id:
+        return {'error': 'Missing image data or student ID'}, 400
+
+    frame_ratio = None
+    if face_image:
+        with STAGE_SECONDS.time(stage='decode'):
+            face_resized = decode_face_crop(image_bytes(face_image), FACE_SIZE)
+    else:
+        # Decode straight to grayscale, at reduced scale for large JPEGs
+        with STAGE_SECONDS.time(stage='decode'):
+            gray, scale = decode_gray_for_faces(image_bytes(image_data))
+        if gray is None:
+            REJECTIONS.inc(reason='decode_failed')
+            return {'error': 'Failed to decode image'}, 400
+
+        if face_box is not None:
+            box = parse_face_box(scale_box(face_box, scale), gray.shape)
+            face_resized = crop_face(gray, box, FACE_SIZE)
+            frame_ratio = box[2] / gray.shape[1]
+        else:
+            with STAGE_SECONDS.time(stage='detect'):
+                faces = detect_faces(gray, 1.2, 5)
+
+            print(f"Detected {len(faces)} faces in the image")
+
+            if len(faces) == 0:
+                REJECTIONS.inc(reason='no_face')
+                return {'error': 'No face detected. Please ensure your face is clearly visible in the frame.'}, 400
+            elif len(faces) > 1:
+                REJECTIONS.inc(reason='multiple_faces')
+                return {'error': f'Multiple faces ({len(faces)}) detected. Please ensure only your face is visible.'}, 400
+
+            # Save the face
+            x, y, w, h = faces[0]
+            face_img = gray[y:y+h, x:x+w]
+            face_resized = cv2.resize(face_img, FACE_SIZE)
+            frame_ratio = w / gray.shape[1]
+
+    # A poor enrollment sample would hurt every later verification of this student
+    reason = check_face(face_resized, frame_ratio)
+    if reason:
+        return quality_error(reason), 400
+
+    filename = f"{student_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
+
+    # Save the sample and append its histogram to the shared store
+    with STAGE_SECONDS.time(stage='enroll'):
+        template_store.add_face(filename, face_resized)
+        # The Node server saves the registration photo as <student_id>.jpg just before calling us;
+        # pick up a new or replaced one now rather than on the next full sync
+        if STUDENT_ID_PATTERN.match(str(student_id)):
+            template_store.sync(filenames=[f'{student_id}.jpg'])
+    registered_faces.invalidate(str(student_id))
+    if class_group:
+        rosters.add(str(class_group).strip(), student_id)
+
+    print(f"Saved face image to {os.path.join(KNOWN_FACES_DIR, filename)}")
+
+    return {
+        'success': True,
+        'message': f'Face registered successfully for student {student_id}'
+    }, 200
 
 @app.route('/register-face', methods=['POST'])
 def register_face():
     try:
-        # Get the image data from request
-        image_data = request.json.get('image')
-        student_id = request.json.get('studentId')
-        
-        if not image_data or not student_id:
-            return jsonify({'error': 'Missing image data or student ID'}), 400
+        # Accepts JSON with base64 images, multipart uploads or a raw octet-stream body
+        data = request_fields(request, ('image', 'face_image'))
+        if data is None:
+            return jsonify({'error': 'Invalid request body'}), 400
+        # Optional fast path: the client already located or cropped the face
+        body, status = register_student_face(
+            data.get('studentId'),
+            data.get('image'),
+            data.get('face_box'),
+            data.get('face_image'),
+            data.get('class_group'))
+        return jsonify(body), status
+
+    except FaceInputError as e:
+        REJECTIONS.inc(reason='invalid_input')
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error in register_face: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def live_face(current_image, face_box=None, face_image=None):
+    """Crop the live face, skipping the full-frame cascade when the client sent a crop or a box.
+
+    Returns (face, None) or (None, (body, status)) when no single usable face was
+    found. Raises FaceInputError when a client supplied box or crop is invalid.
+    """
+    face, frame_ratio, error = crop_live_face(current_image, face_box, face_image)
+    if error:
+        return None, error
+    # Rejecting a blurry or dark frame here is cheaper than the predict it would fail
+    reason = check_face(face, frame_ratio)
+    if reason:
+        return None, (quality_error(reason), 400)
+    return face, None
+
+def crop_live_face(current_image, face_box, face_image):
+    """(face, face width over frame width, error) for live_face()"""
+    if face_image:
+        with STAGE_SECONDS.time(stage='decode'):
+            return decode_face_crop(image_bytes(face_image), FACE_SIZE), None, None
+
+    with STAGE_SECONDS.time(stage='decode'):
+        current_gray, scale = decode_gray_for_faces(image_bytes(current_image))
+    if current_gray is None:
+        REJECTIONS.inc(reason='decode_failed')
+        return None, None, ({'error': 'Failed to decode current image'}, 400)
+    if face_box is not None:
+        box = parse_face_box(scale_box(face_box, scale), current_gray.shape)
+        return crop_face(current_gray, box, FACE_SIZE), box[2] / current_gray.shape[1], None
 
-        # Convert base64 image to numpy array
-        import base64
-        import re
-        image_data = re.sub('^data:image/.+;base64,', '', image_data)
-        image_bytes = base64.b64decode(image_data)
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    with STAGE_SECONDS.time(stage='detect'):
+        current_faces = detect_faces(current_gray, 1.2, 5)
+    if len(current_faces) == 0:
+        REJECTIONS.inc(reason='no_face')
+        return None, None, ({'error': 'No face detected in current image'}, 400)
+    if len(current_faces) > 1:
+        REJECTIONS.inc(reason='multiple_faces')
+        return None, None, ({'error': 'Multiple faces detected in current image'}, 400)
 
-        if frame is None:
-            return jsonify({'error': 'Failed to decode image'}), 400
+    x, y, w, h = current_faces[0]
+    return cv2.resize(current_gray[y:y+h, x:x+w], FACE_SIZE), w / current_gray.shape[1], None
 
-        # Convert to grayscale
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.2, 5)
+def verify_student(student_id, current_image, registered_image=None, face_box=None, face_image=None):
+    """Verify one live frame against a student's registered face, returning (body, status)"""
+    if not (current_image or face_image) or not (registered_image or student_id):
+        return {'error': 'Missing image data'}, 400
 
-        print(f"Detected {len(faces)} faces in the image")
+    if registered_image:
+        registered_bytes = image_bytes(registered_image)
+    else:
+        registered_bytes = registered_image_bytes(str(student_id))
+        if registered_bytes is None:
+            return {
+                'error': 'No registered face for this student',
+                'code': 'registered_image_required'
+            }, 404
 
-        if len(faces) == 0:
-            return jsonify({'error': 'No face detected. Please ensure your face is clearly visible in the frame.'}), 400
-        elif len(faces) > 1:
-            return jsonify({'error': f'Multiple faces ({len(faces)}) detected. Please ensure only your face is visible.'}), 400
+    # Without a student id, fall back to keying the cache by the image itself
+    image_hash = content_hash(registered_bytes)
+    cache_key = str(student_id) if student_id else image_hash
+
+    # A retried or resent frame gets the verdict computed for it a moment ago
+    result_key = request_key(cache_key, image_hash, current_image, face_box, face_image)
+    cached = verify_results.get(result_key)
+    if cached is not None:
+        return cached
+    result = compare_live_face(cache_key, image_hash, registered_bytes, current_image, face_box, face_image)
+    if result[1] in CACHED_STATUSES:
+        verify_results.put(result_key, result)
+    return result
+
+def compare_live_face(cache_key, image_hash, registered_bytes, current_image, face_box=None, face_image=None):
+    """Match the live face against the registered one, returning (body, status)"""
+    registered_recognizer = registered_faces.get(cache_key, image_hash)
+
+    if registered_recognizer is None:
+        with STAGE_SECONDS.time(stage='registered_face'):
+            registered_gray = decode_gray_image(registered_bytes)
+            if registered_gray is None:
+                return {'error': 'Failed to decode registered image'}, 400
+            registered_detections = detect_faces(registered_gray, 1.2, 5)
+            if len(registered_detections) == 0:
+                return {'error': 'No face detected in registered image'}, 400
+            x, y, w, h = registered_detections[0]
+            registered_face = cv2.resize(registered_gray[y:y+h, x:x+w], FACE_SIZE)
+            registered_recognizer = registered_faces.put(cache_key, image_hash, registered_face)
+
+    # Process current image
+    try:
+        current_face, error = live_face(current_image, face_box, face_image)
+    except FaceInputError as e:
+        REJECTIONS.inc(reason='invalid_input')
+        return {'error': str(e)}, 400
+    if error:
+        return error
 
-        # Save the face
-        x, y, w, h = faces[0]
-        face_img = gray[y:y+h, x:x+w]
-        face_resized = cv2.resize(face_img, FACE_SIZE)
-        filename = f"{student_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-        filepath = os.path.join(KNOWN_FACES_DIR, filename)
-        cv2.imwrite(filepath, face_resized)
+    # Compare faces using LBPH
+    try:
+        # Predict the current face against the cached registered histogram
+        with STAGE_SECONDS.time(stage='predict'):
+            pred_label, confidence = registered_recognizer.predict(current_face)
+    except Exception as e:
+        print(f"Face comparison error: {str(e)}")
+        return {'success': False, 'error': 'Face comparison failed'}, 200
+    CONFIDENCE.observe(confidence)
+
+    if confidence < THRESHOLD:
+        return {'success': True, 'confidence': float(confidence)}, 200
+    return {
+        'success': False,
+        'error': 'Face verification failed',
+        'confidence': float(confidence)
+    }, 200
+
+@app.route('/verify-face', methods=['POST'])
+def verify_face():
+    try:
+        data = request_fields(request, ('current_image', 'registered_image', 'face_image'))
+        if data is None:
+            return jsonify({'error': 'Invalid request body'}), 400
+        # The registered image is optional: by default it is read from known_faces
+        # and its histogram is served from the cache
+        body, status = verify_student(
+            data.get('student_id'),
+            data.get('current_image'),
+            data.get('registered_image'),
+            data.get('face_box'),
+            data.get('face_image'))
+        return jsonify(body), status
+
+    except Exception as e:
+        print(f"Error in verify_face: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-        print(f"Saved face image to {filepath}")
+def verify_batch_item(item):
+    """Run one /verify-batch item, turning failures into a per-item error"""
+    student_id = item.get('student_id')
+    try:
+        body, status = verify_student(
+            student_id, item.get('current_image'), item.get('registered_image'),
+            item.get('face_box'), item.get('face_image'))
+    except Exception as e:
+        print(f"Error verifying batch item for {student_id}: {str(e)}")
+        body, status = {'error': str(e)}, 500
+    body.setdefault('success', False)
+    body.update({'student_id': student_id, 'status': status})
+    return body
 
-        # Retrain the recognizer
-        train_recognizer()
+@app.route('/verify-batch', methods=['POST'])
+def verify_batch():
+    try:
+        items = request.json.get('items')
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'Missing items'}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'Too many items, at most {MAX_BATCH_SIZE} per batch'}), 413
+        if not all(isinstance(item, dict) for item in items):
+            return jsonify({'error': 'Each item must be an object'}), 400
 
+        results = list(batch_executor.map(verify_batch_item, items))
         return jsonify({
             'success': True,
-            'message': f'Face registered successfully for student {student_id}'
+            'verified': sum(1 for r in results if r['success']),
+            'results': results
         })
 
     except Exception as e:
-        print(f"Error in register_face: {str(e)}")
+        print(f"Error in verify_batch: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-@app.route('/verify-face', methods=['POST'])
-def verify_face():
+def identify_classroom(image_data, class_group=None, roster=None):
+    """Identify every face in a classroom frame, returning (body, status).
+
+    With class_group or roster only those students are candidates.
+    """
+    if not image_data:
+        return {'error': 'Missing image data'}, 400
     try:
-        # Get both images from request
-        registered_image = request.json.get('registered_image')
-        current_image = request.json.get('current_image')
-        
-        if not registered_image or not current_image:
-            return jsonify({'error': 'Missing image data'}), 400
-
-        # Convert base64 images to numpy arrays
-        import base64
-        import re
-
-        # Process registered image
-        registered_image = re.sub('^data:image/.+;base64,', '', registered_image)
-        registered_bytes = base64.b64decode(registered_image)
-        registered_nparr = np.frombuffer(registered_bytes, np.uint8)
-        registered_frame = cv2.imdecode(registered_nparr, cv2.IMREAD_COLOR)
-        registered_gray = cv2.cvtColor(registered_frame, cv2.COLOR_BGR2GRAY)
-
-        # Process current image
-        current_image = re.sub('^data:image/.+;base64,', '', current_image)
-        current_bytes = base64.b64decode(current_image)
-        current_nparr = np.frombuffer(current_bytes, np.uint8)
-        current_frame = cv2.imdecode(current_nparr, cv2.IMREAD_COLOR)
-        current_gray = cv2.cvtColor(current_frame, cv2.COLOR_BGR2GRAY)
-
-        # Detect faces in both images
-        registered_faces = face_cascade.detectMultiScale(registered_gray, 1.2, 5)
-        current_faces = face_cascade.detectMultiScale(current_gray, 1.2, 5)
-
-        if len(registered_faces) == 0:
-            return jsonify({'error': 'No face detected in registered image'}), 400
-        if len(current_faces) == 0:
-            return jsonify({'error': 'No face detected in current image'}), 400
-        if len(current_faces) > 1:
-            return jsonify({'error': 'Multiple faces detected in current image'}), 400
-
-        # Extract and resize faces
-        x, y, w, h = registered_faces[0]
-        registered_face = cv2.resize(registered_gray[y:y+h, x:x+w], FACE_SIZE)
-
-        x, y, w, h = current_faces[0]
-        current_face = cv2.resize(current_gray[y:y+h, x:x+w], FACE_SIZE)
-
-        # Compare faces using LBPH
-        try:
-            # Create a temporary recognizer for this comparison
-            temp_recognizer = cv2.face.LBPHFaceRecognizer_create()
-            temp_recognizer.train([registered_face], np.array([0]))
-
-            # Predict the current face
-            pred_label, confidence = temp_recognizer.predict(current_face)
-            
-            if confidence < THRESHOLD:
-                return jsonify({
-                    'success': True,
-                    'confidence': float(confidence)
-                })
-            else:
-                return jsonify({
-                    'success': False,
-                    'error': 'Face verification failed',
-                    'confidence': float(confidence)
-                })
-        except Exception as e:
-            print(f"Face comparison error: {str(e)}")
-            return jsonify({
-                'success': False,
-                'error': 'Face comparison failed'
-            })
+        gallery = search_gallery(class_group, roster)
+    except ValueError as e:
+        return {'error': f'Invalid class_group or roster: {str(e)}'}, 400
+
+    with STAGE_SECONDS.time(stage='decode'):
+        gray, scale = decode_gray_for_faces(image_bytes(image_data), CLASSROOM_MIN_FACE_RATIO,
+                                            CLASSROOM_DETECTION_WIDTH)
+    if gray is None:
+        REJECTIONS.inc(reason='decode_failed')
+        return {'error': 'Failed to decode image'}, 400
+
+    with STAGE_SECONDS.time(stage='detect_classroom'):
+        faces = detect_classroom_faces(gray)
+    print(f"Detected {len(faces)} faces in the classroom image")
+    if len(faces) == 0:
+        REJECTIONS.inc(reason='no_face')
+        return {'error': 'No face detected in the image'}, 400
+    if len(gallery) == 0 and class_group is None and roster is None:
+        return {'error': 'No faces registered'}, 409
+
+    if len(gallery) == 0:
+        # Nobody in this class group has registered a face yet
+        recognized, unknown = [], len(faces)
+    else:
+        with STAGE_SECONDS.time(stage='identify'):
+            recognized, unknown = gallery.identify_faces(gray, faces, THRESHOLD, FACE_SIZE)
+    for match in recognized:
+        # Report boxes in the coordinates of the uploaded image
+        match['box'] = [int(round(v * scale)) for v in match['box']]
+    return {
+        'success': True,
+        'faces_detected': len(faces),
+        'unknown_faces': unknown,
+        'recognized': recognized
+    }, 200
 
+@app.route('/identify-faces', methods=['POST'])
+def identify_faces():
+    try:
+        data = request_fields(request, ('image',))
+        if data is None:
+            return jsonify({'error': 'Invalid request body'}), 400
+        body, status = identify_classroom(data.get('image'), data.get('class_group'), data.get('roster'))
+        return jsonify(body), status
+
+    except FaceInputError as e:
+        REJECTIONS.inc(reason='invalid_input')
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        print(f"Error in verify_face: {str(e)}")
+        print(f"Error in identify_faces: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def identify_student(data):
+    """Rank the enrolled students closest to a single live face, returning (body, status)"""
+    if not (data.get('current_image') or data.get('face_image')):
+        return {'error': 'Missing image data'}, 400
+    try:
+        k = min(int(data.get('k', 5)), MAX_TOP_K)
+    except (TypeError, ValueError):
+        return {'error': 'k must be an integer'}, 400
+    metric = data.get('metric', 'chisqr')
+    if k < 1 or metric not in METRICS:
+        return {'error': f"k must be positive and metric one of {', '.join(METRICS)}"}, 400
+    class_group, roster = data.get('class_group'), data.get('roster')
+    try:
+        index = search_gallery(class_group, roster)
+    except ValueError as e:
+        return {'error': f'Invalid class_group or roster: {str(e)}'}, 400
+
+    try:
+        face, error = live_face(data.get('current_image'), data.get('face_box'), data.get('face_image'))
+    except FaceInputError as e:
+        REJECTIONS.inc(reason='invalid_input')
+        return {'error': str(e)}, 400
+    if error:
+        return error
+
+    if len(index) == 0 and class_group is None and roster is None:
+        return {'error': 'No faces registered'}, 409
+
+    if len(index) == 0:
+        # Nobody in this class group or roster has registered a face yet, as in identify_classroom
+        candidates = []
+    else:
+        with STAGE_SECONDS.time(stage='search'):
+            candidates = index.search(face, k, metric, per_student=parse_flag(data.get('per_student')))
+    best = candidates[0] if candidates else None
+    return {
+        'success': True,
+        'metric': metric,
+        'candidates': [{'student_id': s, 'distance': d} for s, d in candidates],
+        # The LBPH threshold only applies to chi-square distances
+        'match': best[0] if best and metric == 'chisqr' and best[1] < THRESHOLD else None
+    }, 200
+
+@app.route('/identify', methods=['POST'])
+def identify():
+    try:
+        data = request_fields(request, ('current_image', 'face_image'))
+        if data is None:
+            return jsonify({'error': 'Invalid request body'}), 400
+        body, status = identify_student(data)
+        return jsonify(body), status
+
+    except Exception as e:
+        print(f"Error in identify: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def set_class_roster(class_group, student_ids):
+    """Replace the members of a class group, returning (body, status)"""
+    try:
+        student_ids = parse_id_list(student_ids)
+    except ValueError as e:
+        return {'error': f'Invalid student_ids: {str(e)}'}, 400
+    if len(student_ids) > MAX_ROSTER_SIZE:
+        return {'error': f'Too many students, at most {MAX_ROSTER_SIZE} per class group'}, 413
+    rosters.set_roster(class_group, student_ids)
+    return {'success': True, 'class_group': class_group, 'students': len(student_ids)}, 200
+
+def class_roster(class_group):
+    """Members of a class group, returning (body, status)"""
+    students = rosters.rosters().get(class_group)
+    if students is None:
+        return {'error': 'Unknown class group'}, 404
+    return {'success': True, 'class_group': class_group, 'student_ids': students}, 200
+
+@app.route('/class-groups/<class_group>', methods=['GET', 'PUT'])
+def class_group_roster(class_group):
+    try:
+        if request.method == 'GET':
+            body, status = class_roster(class_group)
+        else:
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict) or 'student_ids' not in data:
+                return jsonify({'error': 'Missing student_ids'}), 400
+            body, status = set_class_roster(class_group, data['student_ids'])
+        return jsonify(body), status
+
+    except Exception as e:
+        print(f"Error in class_group_roster: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def compact_samples(data):
+    """Drop duplicate and surplus face samples, then sync the template store, returning (body, status)"""
+    try:
+        max_per_student = int(data.get('max_per_student', MAX_SAMPLES_PER_STUDENT))
+        student_ids = parse_id_list(data.get('student_ids')) or None
+    except (TypeError, ValueError):
+        return {'error': 'max_per_student must be an integer and student_ids a list'}, 400
+    if max_per_student < 1:
+        return {'error': 'max_per_student must be at least 1'}, 400
+    dry_run = parse_flag(data.get('dry_run'), default=False)
+
+    plan = compact_gallery(template_store, max_per_student, student_ids=student_ids, dry_run=dry_run)
+    return {
+        'success': True,
+        'dry_run': dry_run,
+        'kept': len(plan['kept']),
+        'removed': plan['removed'],
+        'unreadable': plan['unreadable']
+    }, 200
+
+@app.route('/gallery/compact', methods=['POST'])
+def compact_gallery_samples():
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Invalid request body'}), 400
+        body, status = compact_samples(data)
+        return jsonify(body), status
+
+    except Exception as e:
+        print(f"Error in compact_gallery_samples: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    # Train the recognizer on startup
-    train_recognizer()
     app.run(port=5000) 
\ No newline at end of file
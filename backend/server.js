@@ -1212,10 +1212,29 @@ app.get("/api/faculty", async (req, res) => {
   }
 });
 
+// Decode a data URL (or bare base64) from the browser into raw image bytes, once
+function imageBuffer(image) {
+  return Buffer.from(image.replace(/^data:image\/[\w+.-]+;base64,/, ''), 'base64');
+}
+
+// Multipart body for the Python service: images go as binary parts instead of base64 inside JSON
+function faceServiceForm(fields, images) {
+  const form = new FormData();
+  for (const [name, value] of Object.entries(fields)) {
+    if (value !== undefined && value !== null) {
+      form.append(name, typeof value === 'string' ? value : JSON.stringify(value));
+    }
+  }
+  for (const [name, buffer] of Object.entries(images)) {
+    form.append(name, new Blob([buffer], { type: 'image/jpeg' }), `${name}.jpg`);
+  }
+  return form;
+}
+
 // Face verification endpoint
 app.post('/verify-attendance', async (req, res) => {
   try {
-    const { student_id, image, date, class_details } = req.body;
+    const { student_id, image, face_box, date, class_details } = req.body;
     console.log('Verifying attendance for:', { student_id, date, class_details });
     if (!student_id || !date || !class_details) {
       return res.status(400).json({
@@ -1235,19 +1254,34 @@ app.post('/verify-attendance', async (req, res) => {
     const imagePath = faces[0].image_path;
     const registeredClassGroup = faces[0].class_group;
 
-    // 2. Read registered image as base64
-    const registeredImageBase64 = fs.readFileSync(imagePath, { encoding: 'base64' });
-
-    // 3. Send both images to Python service
+    // 2. Send the current image to the Python service, which keeps the registered
+    //    face's histogram cached by student id
     let verified = false;
     try {
-      const response = await axios.post('http://127.0.0.1:5000/verify-face', {
-        registered_image: registeredImageBase64,
-        current_image: image
-      });
+      let response;
+      const currentImage = imageBuffer(image);
+      try {
+        response = await axios.post('http://127.0.0.1:5000/verify-face',
+          faceServiceForm({ student_id, face_box }, { current_image: currentImage }));
+      } catch (err) {
+        if (err.response?.data?.code !== 'registered_image_required') {
+          throw err;
+        }
+        // 3. The service cannot find the registered image on its side, so send the file as is
+        response = await axios.post('http://127.0.0.1:5000/verify-face',
+          faceServiceForm({ student_id, face_box }, {
+            current_image: currentImage,
+            registered_image: fs.readFileSync(imagePath)
+          }));
+      }
       verified = response.data.success;
     } catch (err) {
       console.error('Error calling face verification service:', err.message);
+      if (err.response?.status === 429) {
+        // The service sheds load during attendance peaks; the client can simply retry
+        res.set('Retry-After', err.response.headers['retry-after'] || '1');
+        return res.status(503).json({ success: false, message: 'Face verification is busy, please try again' });
+      }
       return res.status(500).json({ success: false, message: 'Face verification service error' });
     }
     if (!verified) {
@@ -1316,6 +1350,217 @@ app.post('/verify-attendance', async (req, res) => {
   }
 });
 
+// Insert or update a 'present' attendance row for one student and class slot
+async function markStudentPresent(student_id, date, class_details) {
+  return pool.query(
+    `INSERT INTO attendance 
+     (student_id, date, subject, class_group, time_slot, room, status) 
+     VALUES (?, ?, ?, ?, ?, ?, 'present')
+     ON DUPLICATE KEY UPDATE 
+     status = 'present',
+     subject = VALUES(subject),
+     class_group = VALUES(class_group),
+     time_slot = VALUES(time_slot),
+     room = VALUES(room)`,
+    [
+      student_id,
+      date,
+      class_details.subject,
+      class_details.class_group,
+      class_details.time_slot,
+      class_details.room
+    ]
+  );
+}
+
+// Batch face verification: one request for a whole class instead of one per student
+app.post('/verify-attendance-batch', async (req, res) => {
+  try {
+    const { students, date, class_details } = req.body;
+    if (!Array.isArray(students) || !students.length || !date || !class_details) {
+      return res.status(400).json({
+        success: false,
+        message: 'Missing required fields'
+      });
+    }
+
+    const studentIds = students.map(s => s.student_id);
+    const [faces] = await pool.query(
+      'SELECT student_id, image_path, class_group FROM student_faces WHERE student_id IN (?)',
+      [studentIds]
+    );
+    const [knownStudents] = await pool.query(
+      'SELECT enrollment_no FROM students WHERE enrollment_no IN (?)',
+      [studentIds]
+    );
+    const faceById = new Map(faces.map(f => [String(f.student_id), f]));
+    const knownIds = new Set(knownStudents.map(s => String(s.enrollment_no)));
+
+    const results = new Map();
+    const items = [];
+    for (const { student_id, image, face_box } of students) {
+      if (!faceById.has(String(student_id))) {
+        results.set(student_id, { student_id, success: false, message: 'No registered face found' });
+      } else if (!knownIds.has(String(student_id))) {
+        results.set(student_id, { student_id, success: false, message: 'Student not found' });
+      } else {
+        items.push({ student_id, current_image: image, face_box });
+      }
+    }
+
+    // Verify every remaining student in one call to the Python service
+    let verifications = [];
+    if (items.length) {
+      try {
+        const response = await axios.post('http://127.0.0.1:5000/verify-batch', { items }, { maxBodyLength: Infinity });
+        verifications = response.data.results;
+
+        // Resend the registered image for students the service has no copy of
+        const missing = verifications
+          .map((v, i) => ({ v, item: items[i] }))
+          .filter(({ v }) => v.code === 'registered_image_required');
+        if (missing.length) {
+          const retry = await axios.post('http://127.0.0.1:5000/verify-batch', {
+            items: missing.map(({ item }) => ({
+              ...item,
+              registered_image: fs.readFileSync(faceById.get(String(item.student_id)).image_path, { encoding: 'base64' })
+            }))
+          }, { maxBodyLength: Infinity });
+          const retried = new Map(retry.data.results.map(r => [r.student_id, r]));
+          verifications = verifications.map(v => retried.get(v.student_id) || v);
+        }
+      } catch (err) {
+        console.error('Error calling batch face verification service:', err.message);
+        if (err.response?.status === 429) {
+          // Busy with other requests; the whole batch can be retried
+          res.set('Retry-After', err.response.headers['retry-after'] || '1');
+          return res.status(503).json({ success: false, message: 'Face verification is busy, please try again' });
+        }
+        return res.status(500).json({ success: false, message: 'Face verification service error' });
+      }
+    }
+
+    for (const verification of verifications) {
+      const { student_id } = verification;
+      if (!verification.success) {
+        results.set(student_id, { student_id, success: false, verified: false, message: verification.error || 'Face verification failed' });
+        continue;
+      }
+
+      const registeredClassGroup = faceById.get(String(student_id)).class_group;
+      if (registeredClassGroup && !class_details.class_group.includes(registeredClassGroup)) {
+        results.set(student_id, { student_id, success: false, verified: true, message: 'Student is not registered for this class group' });
+        continue;
+      }
+
+      try {
+        await markStudentPresent(student_id, date, class_details);
+        results.set(student_id, { student_id, success: true, verified: true, message: 'Attendance marked successfully' });
+      } catch (dbError) {
+        console.error('Database error:', dbError);
+        results.set(student_id, { student_id, success: false, verified: true, message: 'Failed to mark attendance in database' });
+      }
+    }
+
+    const ordered = students.map(({ student_id }) => results.get(student_id));
+    res.json({
+      success: true,
+      marked: ordered.filter(r => r.success).length,
+      results: ordered
+    });
+  } catch (error) {
+    console.error('Error in batch face verification:', error);
+    res.status(500).json({
+      success: false,
+      message: 'Failed to verify attendance',
+      error: process.env.NODE_ENV === 'development' ? error.message : undefined
+    });
+  }
+});
+
+// Classroom snapshot: identify every face in one frame and mark all recognized students
+app.post('/mark-classroom-attendance', async (req, res) => {
+  try {
+    const { image, date, class_details } = req.body;
+    if (!image || !date || !class_details) {
+      return res.status(400).json({
+        success: false,
+        message: 'Missing required fields'
+      });
+    }
+
+    // Only students registered for this lecture's class group(s) are candidates, so the service
+    // searches a small per-group shard and cannot match someone from another class
+    const [registered] = await pool.query('SELECT student_id, class_group FROM student_faces');
+    const roster = registered
+      .filter(f => !f.class_group || class_details.class_group.includes(f.class_group))
+      .map(f => String(f.student_id));
+
+    let identification;
+    try {
+      const response = await axios.post('http://127.0.0.1:5000/identify-faces', { image, roster });
+      identification = response.data;
+    } catch (err) {
+      console.error('Error calling face identification service:', err.message);
+      const status = err.response?.status === 400 ? 400 : 500;
+      return res.status(status).json({
+        success: false,
+        message: err.response?.data?.error || 'Face identification service error'
+      });
+    }
+
+    const recognized = identification.recognized || [];
+    const studentIds = recognized.map(r => r.student_id);
+    let faceById = new Map();
+    let knownIds = new Set();
+    if (studentIds.length) {
+      const [faces] = await pool.query(
+        'SELECT student_id, class_group FROM student_faces WHERE student_id IN (?)',
+        [studentIds]
+      );
+      const [knownStudents] = await pool.query(
+        'SELECT enrollment_no FROM students WHERE enrollment_no IN (?)',
+        [studentIds]
+      );
+      faceById = new Map(faces.map(f => [String(f.student_id), f]));
+      knownIds = new Set(knownStudents.map(s => String(s.enrollment_no)));
+    }
+
+    const results = [];
+    for (const { student_id, confidence } of recognized) {
+      const registeredClassGroup = faceById.get(String(student_id))?.class_group;
+      if (!knownIds.has(String(student_id))) {
+        results.push({ student_id, confidence, success: false, message: 'Student not found' });
+      } else if (registeredClassGroup && !class_details.class_group.includes(registeredClassGroup)) {
+        results.push({ student_id, confidence, success: false, message: 'Student is not registered for this class group' });
+      } else {
+        try {
+          await markStudentPresent(student_id, date, class_details);
+          results.push({ student_id, confidence, success: true, message: 'Attendance marked successfully' });
+        } catch (dbError) {
+          console.error('Database error:', dbError);
+          results.push({ student_id, confidence, success: false, message: 'Failed to mark attendance in database' });
+        }
+      }
+    }
+
+    res.json({
+      success: true,
+      faces_detected: identification.faces_detected,
+      unknown_faces: identification.unknown_faces,
+      marked: results.filter(r => r.success).length,
+      results
+    });
+  } catch (error) {
+    console.error('Error in classroom attendance:', error);
+    res.status(500).json({
+      success: false,
+      message: 'Failed to mark classroom attendance',
+      error: process.env.NODE_ENV === 'development' ? error.message : undefined
+    });
+  }
+});
+
 // Ensure uploads directory exists
 const uploadDir = path.join(__dirname, '..', 'known_faces');
 if (!fs.existsSync(uploadDir)){
@@ -1348,7 +1593,7 @@ app.get('/health', (req, res) => {
 // Face registration endpoint
 app.post('/register-face', async (req, res) => {
   try {
-    const { student_id, image } = req.body;
+    const { student_id, image, face_box } = req.body;
     console.log('Registering face for student:', student_id);
 
     if (!student_id || !image) {
@@ -1389,14 +1634,19 @@ app.post('/register-face', async (req, res) => {
 
     // Save the image
     const imagePath = path.join(dir, `${student_id}.jpg`);
-    const imageData = image.replace(/^data:image\/jpeg;base64,/, '');
-    fs.writeFileSync(imagePath, imageData, 'base64');
+    const imageData = imageBuffer(image);
+    fs.writeFileSync(imagePath, imageData);
 
-    // Send to Python service for face recognition
+    // Send the raw bytes to the Python service for face recognition
     try {
-      const pythonResponse = await axios.post('http://127.0.0.1:5000/register-face', {
-        image: `data:image/jpeg;base64,${imageData}`,
-        studentId: student_id
+      const pythonResponse = await axios.post('http://127.0.0.1:5000/register-face', imageData, {
+        headers: { 'Content-Type': 'application/octet-stream' },
+        params: {
+          studentId: student_id,
+          class_group: classGroup,
+          face_box: Array.isArray(face_box) ? face_box.join(',') : undefined
+        },
+        maxBodyLength: Infinity
       });
 
       if (!pythonResponse.data.success) {
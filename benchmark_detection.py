@@ -0,0 +1,121 @@
+"""Benchmark face detection latency against detection rate.
+
+Runs the Haar cascade on the sample images at several working widths and face
+size bounds, upscaling them to typical webcam and phone resolutions first, and
+compares every configuration with a full-resolution unbounded baseline. `hit` is
+the fraction of frames with at least one face, `recall` the fraction of baseline
+boxes found again (the baseline includes its own false positives).
+
+    python benchmark_detection.py
+    python benchmark_detection.py --resolutions 1920 --widths 320 480 640 --repeat 5
+"""
+import argparse
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+
+import face_detection
+
+DEFAULT_IMAGE_DIRS = ['backend/known_faces', 'backend/uploads/faces', 'known_faces']
+
+
+def load_images(dirs):
+    images = []
+    for directory in dirs:
+        for path in sorted(glob.glob(os.path.join(directory, '*'))):
+            if path.lower().endswith(('.jpg', '.jpeg', '.png')):
+                img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+                if img is not None:
+                    images.append((path, img))
+    return images
+
+
+def iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    ix = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    iy = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = ix * iy
+    union = aw * ah + bw * bh - inter
+    return inter / union if union else 0.0
+
+
+def run(frames, repeat, **kwargs):
+    """Return (latencies in ms, boxes per frame) for one detection configuration"""
+    latencies = []
+    results = []
+    for frame in frames:
+        boxes = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            boxes = face_detection.detect_faces(frame, 1.2, 5, **kwargs)
+            latencies.append((time.perf_counter() - start) * 1000)
+        results.append(boxes)
+    return np.array(latencies), results
+
+
+def hit_rate(results):
+    """Fraction of frames where at least one face was found"""
+    return sum(1 for r in results if len(r)) / len(results)
+
+
+def agreement(baseline, results):
+    """Fraction of baseline faces that a configuration also finds (IoU >= 0.5)"""
+    found = total = 0
+    for expected, got in zip(baseline, results):
+        for box in expected:
+            total += 1
+            if any(iou(box, other) >= 0.5 for other in got):
+                found += 1
+    return found / total if total else 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dirs', nargs='+', default=DEFAULT_IMAGE_DIRS)
+    parser.add_argument('--resolutions', nargs='+', type=int, default=[640, 1280, 1920],
+                        help='frame widths the samples are resized to before detection')
+    parser.add_argument('--widths', nargs='+', type=int, default=[320, 480, 640, 960],
+                        help='working widths to benchmark')
+    parser.add_argument('--min-ratios', nargs='+', type=float, default=[0.0, 0.1, 0.2])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    images = load_images(args.dirs)
+    if not images:
+        print('No images found in', ', '.join(args.dirs))
+        return
+    print(f"{len(images)} sample images\n")
+
+    header = f"{'frame':>6} {'width':>6} {'min':>5} {'mean ms':>8} {'p50 ms':>7} {'p95 ms':>7} {'faces':>6} {'hit':>5} {'recall':>7}"
+    for resolution in args.resolutions:
+        frames = []
+        for _, img in images:
+            height = int(round(img.shape[0] * resolution / img.shape[1]))
+            frames.append(cv2.resize(img, (resolution, height), interpolation=cv2.INTER_LINEAR))
+
+        # Baseline: full resolution, no face size bounds, i.e. the old behaviour
+        base_latency, baseline = run(frames, args.repeat, working_width=resolution,
+                                     min_face_ratio=0.0, max_face_ratio=1.0)
+        print(header)
+        print(f"{resolution:>6} {'full':>6} {'-':>5} {base_latency.mean():8.1f} "
+              f"{np.percentile(base_latency, 50):7.1f} {np.percentile(base_latency, 95):7.1f} "
+              f"{sum(len(b) for b in baseline):6d} {hit_rate(baseline):5.2f} {1.0:7.2f}")
+        for width in args.widths:
+            if width >= resolution:
+                continue
+            for min_ratio in args.min_ratios:
+                latency, results = run(frames, args.repeat, working_width=width,
+                                       min_face_ratio=min_ratio, max_face_ratio=1.0)
+                print(f"{resolution:>6} {width:>6} {min_ratio:5.2f} {latency.mean():8.1f} "
+                      f"{np.percentile(latency, 50):7.1f} {np.percentile(latency, 95):7.1f} "
+                      f"{sum(len(r) for r in results):6d} {hit_rate(results):5.2f} "
+                      f"{agreement(baseline, results):7.2f}")
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+"""Benchmark every stage of the recognition pipeline and write the timings as JSON.
+
+Uses the sample faces (plus flipped, brightened, darkened, blurred, rotated and
+noisy copies of each) to time the stages a verification goes through: base64
+decode, image decode (full and reduced), Haar detection, crop resize, the
+quality gate and histogram extraction; LBPH training and prediction against galleries of
+several sizes; and end-to-end `/verify-face` requests through the Flask test
+client of backend/face_verify_service.py, run on a copy of known_faces in a
+temporary directory. Every stage reports mean, p50, p95 and p99 in ms.
+
+    python benchmark_pipeline.py
+    python benchmark_pipeline.py --gallery-sizes 50 500 2000 --requests 300 --output before.json
+    python benchmark_pipeline.py --output after.json --compare before.json
+"""
+import argparse
+import base64
+import glob
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from face_detection import FACE_SIZE, detect_faces
+from face_gallery import FaceGallery, extract_histograms
+from face_quality import assess_face
+from image_io import decode_gray_for_faces, decode_gray_image, image_bytes
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_IMAGE_DIRS = [os.path.join(ROOT, 'backend', 'known_faces'), os.path.join(ROOT, 'backend', 'uploads', 'faces')]
+BACKEND_SERVICE = os.path.join(ROOT, 'backend', 'face_verify_service.py')
+BACKEND_FACES_DIR = os.path.join(ROOT, 'backend', 'known_faces')
+JPEG_QUALITY = 90
+# p50 slowdowns beyond this fraction are flagged by --compare
+DEFAULT_TOLERANCE = 0.2
+
+
+def load_images(dirs):
+    """Colour sample images, as uploads are colour JPEGs"""
+    images = []
+    for directory in dirs:
+        for path in sorted(glob.glob(os.path.join(directory, '*'))):
+            if path.lower().endswith(('.jpg', '.jpeg', '.png')):
+                img = cv2.imread(path)
+                if img is not None:
+                    images.append((path, img))
+    return images
+
+
+def augment(img, rng):
+    """The image plus synthetic variants covering lighting, blur, pose and sensor noise"""
+    h, w = img.shape[:2]
+    rotation = cv2.getRotationMatrix2D((w / 2, h / 2), float(rng.uniform(-12, 12)), 1.0)
+    noise = rng.normal(0, 8, img.shape)
+    return {
+        'original': img,
+        'flipped': cv2.flip(img, 1),
+        'bright': cv2.convertScaleAbs(img, alpha=1.2, beta=30),
+        'dark': cv2.convertScaleAbs(img, alpha=0.6, beta=-20),
+        'blurred': cv2.GaussianBlur(img, (7, 7), 0),
+        'rotated': cv2.warpAffine(img, rotation, (w, h), borderMode=cv2.BORDER_REPLICATE),
+        'noisy': np.clip(img + noise, 0, 255).astype(np.uint8),
+    }
+
+
+def to_frame(img, width):
+    """Resize to a camera frame width and encode as the JPEG a client would upload"""
+    height = int(round(img.shape[0] * width / img.shape[1]))
+    frame = cv2.resize(img, (width, height), interpolation=cv2.INTER_LINEAR)
+    return cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])[1].tobytes()
+
+
+def percentiles(latencies):
+    """Summary of latencies in ms"""
+    latencies = np.asarray(latencies, dtype=np.float64)
+    if len(latencies) == 0:
+        return {'n': 0}
+    return {
+        'n': int(len(latencies)),
+        'mean': float(latencies.mean()),
+        'p50': float(np.percentile(latencies, 50)),
+        'p95': float(np.percentile(latencies, 95)),
+        'p99': float(np.percentile(latencies, 99)),
+    }
+
+
+def timed(fn, inputs, repeat):
+    """Call fn on every input repeat times, return (latencies in ms, last results)"""
+    latencies = []
+    results = []
+    for item in inputs:
+        result = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn(item)
+            latencies.append((time.perf_counter() - start) * 1000)
+        results.append(result)
+    return latencies, results
+
+
+def bench_stages(frames, repeat):
+    """Per-stage latencies for one live frame, from the base64 string to a histogram"""
+    encoded = [base64.b64encode(data).decode('ascii') for data in frames]
+    stages = {}
+    latencies, raw = timed(image_bytes, encoded, repeat)
+    stages['base64_decode'] = percentiles(latencies)
+    latencies, grays = timed(decode_gray_image, raw, repeat)
+    stages['image_decode'] = percentiles(latencies)
+    latencies, _ = timed(decode_gray_for_faces, raw, repeat)
+    stages['reduced_decode'] = percentiles(latencies)
+    latencies, detections = timed(lambda gray: detect_faces(gray, 1.2, 5), grays, repeat)
+    stages['detect'] = percentiles(latencies)
+
+    crops = [gray[y:y+h, x:x+w] for gray, boxes in zip(grays, detections) if len(boxes)
+             for (x, y, w, h) in boxes[:1]]
+    latencies, faces = timed(lambda crop: cv2.resize(crop, FACE_SIZE), crops, repeat)
+    stages['resize'] = percentiles(latencies)
+    latencies, _ = timed(assess_face, faces, repeat)
+    stages['quality'] = percentiles(latencies)
+    latencies, _ = timed(lambda face: extract_histograms([face]), faces, repeat)
+    stages['extract_histogram'] = percentiles(latencies)
+    return stages, faces, len(crops) / len(grays) if grays else 0.0
+
+
+def synthetic_gallery(faces, size, rng):
+    """size distinct 200x200 faces, recycling the detected ones with fresh noise and shifts"""
+    gallery = []
+    for i in range(size):
+        face = faces[i % len(faces)]
+        if i >= len(faces):
+            shift = np.float32([[1, 0, rng.integers(-6, 7)], [0, 1, rng.integers(-6, 7)]])
+            face = cv2.warpAffine(face, shift, FACE_SIZE, borderMode=cv2.BORDER_REPLICATE)
+            face = np.clip(face + rng.normal(0, 4, face.shape), 0, 255).astype(np.uint8)
+        gallery.append(face)
+    return gallery
+
+
+def bench_training(faces, sizes, probes, train_repeat, rng):
+    """LBPH train time and predict/gallery search latency against each gallery size"""
+    results = []
+    probe_histograms = extract_histograms(probes)
+    for size in sizes:
+        gallery_faces = synthetic_gallery(faces, size, rng)
+        labels = np.arange(size)
+        train_latencies = []
+        recognizer = None
+        for _ in range(train_repeat):
+            recognizer = cv2.face.LBPHFaceRecognizer_create()
+            start = time.perf_counter()
+            recognizer.train(gallery_faces, labels)
+            train_latencies.append((time.perf_counter() - start) * 1000)
+        predict_latencies, _ = timed(recognizer.predict, probes, 1)
+        gallery = FaceGallery(extract_histograms(gallery_faces), labels, {int(l): str(l) for l in labels})
+        search_latencies, _ = timed(lambda probe: gallery.search_histogram(probe, 5), probe_histograms, 1)
+        results.append({
+            'gallery_size': size,
+            'train': percentiles(train_latencies),
+            'predict': percentiles(predict_latencies),
+            'gallery_search': percentiles(search_latencies),
+        })
+        print(f"  gallery {size:>6}: train {np.median(train_latencies):9.1f} ms, "
+              f"predict p50 {results[-1]['predict']['p50']:7.2f} ms, "
+              f"search p50 {results[-1]['gallery_search']['p50']:7.2f} ms")
+    return results
+
+
+def load_backend_service(workdir):
+    """Import backend/face_verify_service.py with workdir as its working directory"""
+    spec = importlib.util.spec_from_file_location('benchmark_backend_service', BACKEND_SERVICE)
+    module = importlib.util.module_from_spec(spec)
+    previous = os.getcwd()
+    os.chdir(workdir)
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        os.chdir(previous)
+        raise
+    return module, previous
+
+
+def bench_verify_face(requests, width, rng):
+    """End-to-end /verify-face latency and throughput through the Flask test client"""
+    students = sorted(os.path.splitext(f)[0] for f in os.listdir(BACKEND_FACES_DIR)
+                      if f.endswith('.jpg') and '_' not in f)
+    if not students:
+        return None
+    bodies = []
+    for student_id in students:
+        img = cv2.imread(os.path.join(BACKEND_FACES_DIR, f'{student_id}.jpg'))
+        for name, variant in augment(img, rng).items():
+            bodies.append((name, {
+                'student_id': student_id,
+                'current_image': base64.b64encode(to_frame(variant, width)).decode('ascii'),
+            }))
+
+    workdir = tempfile.mkdtemp(prefix='face-benchmark-')
+    shutil.copytree(BACKEND_FACES_DIR, os.path.join(workdir, 'known_faces'))
+    service, previous = load_backend_service(workdir)
+    # The bodies repeat; time the pipeline, not the cache for resubmitted frames
+    service.verify_results.ttl = 0
+    try:
+        client = service.app.test_client()
+        # Warm-up fills the registered face cache, as on a running server
+        for name, body in bodies:
+            if name == 'original':
+                client.post('/verify-face', json=body)
+        latencies = []
+        statuses = {}
+        verified = 0
+        started = time.perf_counter()
+        for i in range(requests):
+            start = time.perf_counter()
+            response = client.post('/verify-face', json=bodies[i % len(bodies)][1])
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+            verified += bool((response.get_json() or {}).get('success'))
+        elapsed = time.perf_counter() - started
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return dict(percentiles(latencies), throughput=requests / elapsed, statuses=statuses,
+                verified=verified / requests)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results):
+    """{stage name: stats} over every latency summary in a results file"""
+    flat = {f'stage.{name}': stats for name, stats in results.get('stages', {}).items()}
+    for entry in results.get('training', []):
+        for key in ('train', 'predict', 'gallery_search'):
+            flat[f"{key}.{entry['gallery_size']}"] = entry[key]
+    if results.get('verify_face'):
+        flat['verify_face'] = results['verify_face']
+    return flat
+
+
+def compare(previous, current, tolerance):
+    """Print p50/p95 of both runs side by side, return the stages that got slower"""
+    old, new = flatten(previous), flatten(current)
+    print(f"\nCompared with {previous['meta'].get('commit') or 'previous run'}")
+    print(f"{'stage':<28} {'old p50':>9} {'new p50':>9} {'old p95':>9} {'new p95':>9} {'change':>8}")
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        if not old[name].get('n') or not new[name].get('n'):
+            continue
+        change = new[name]['p50'] / old[name]['p50'] - 1 if old[name]['p50'] else 0.0
+        flag = ''
+        if change > tolerance:
+            flag = '  slower'
+            regressions.append(name)
+        print(f"{name:<28} {old[name]['p50']:9.2f} {new[name]['p50']:9.2f} {old[name]['p95']:9.2f} "
+              f"{new[name]['p95']:9.2f} {change:+7.0%}{flag}")
+    return regressions
+
+
+def print_stages(stages):
+    print(f"{'stage':<18} {'n':>6} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, stats in stages.items():
+        if stats['n']:
+            print(f"{name:<18} {stats['n']:6d} {stats['mean']:8.2f} {stats['p50']:8.2f} "
+                  f"{stats['p95']:8.2f} {stats['p99']:8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dirs', nargs='+', default=DEFAULT_IMAGE_DIRS)
+    parser.add_argument('--resolution', type=int, default=1280, help='width of the uploaded test frames')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per frame and stage')
+    parser.add_argument('--gallery-sizes', nargs='+', type=int, default=[10, 100, 500, 1000])
+    parser.add_argument('--train-repeat', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=100, help='/verify-face requests to send, 0 to skip')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='p50 slowdown reported as a regression by --compare')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    images = load_images(args.dirs)
+    if not images:
+        print('No images found in', ', '.join(args.dirs))
+        return 1
+    frames = [to_frame(variant, args.resolution) for _, img in images for variant in augment(img, rng).values()]
+    print(f"{len(images)} sample images, {len(frames)} frames at {args.resolution} px\n")
+
+    stages, faces, hit_rate = bench_stages(frames, args.repeat)
+    print_stages(stages)
+    print(f"faces found in {hit_rate:.0%} of frames\n")
+    if not faces:
+        print('No faces detected, skipping training and prediction')
+        training = []
+    else:
+        print('LBPH training and prediction')
+        training = bench_training(faces, args.gallery_sizes, faces[:50], args.train_repeat, rng)
+
+    verify_face = None
+    if args.requests > 0:
+        verify_face = bench_verify_face(args.requests, args.resolution, rng)
+        if verify_face:
+            print(f"\n/verify-face: {verify_face['throughput']:.1f} requests/s, p50 {verify_face['p50']:.1f} ms, "
+                  f"p95 {verify_face['p95']:.1f} ms, p99 {verify_face['p99']:.1f} ms, "
+                  f"verified {verify_face['verified']:.0%}, statuses {verify_face['statuses']}")
+
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+            'args': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+            'images': len(images),
+            'frames': len(frames),
+            'face_hit_rate': hit_rate,
+        },
+        'stages': stages,
+        'training': training,
+        'verify_face': verify_face,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} stages slower by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from metrics import REGISTRY
+
+# Identical frames resubmitted within this many seconds get the cached verdict
+RESULT_CACHE_TTL = float(os.environ.get('FACE_RESULT_CACHE_TTL', 10))
+RESULT_CACHE_BYTES = int(os.environ.get('FACE_RESULT_CACHE_BYTES', 4 * 1024 * 1024))
+# Per entry bookkeeping (OrderedDict node, tuple, floats) on top of the key and body
+RESULT_ENTRY_OVERHEAD = 200
+
+RESULT_CACHE_LOOKUPS = REGISTRY.counter('face_result_cache_lookups_total',
+                                        'Verification result cache lookups by outcome', ('result',))
+
+
+def content_hash(data):
+    """Hash of raw image bytes, used to tell whether a registered image changed"""
+    return hashlib.sha1(data).hexdigest()
+
+
+def request_key(*parts):
+    """Cache key for a request: image fields as raw bytes or base64 strings, other fields by value"""
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        elif not isinstance(part, (bytes, bytearray, memoryview)):
+            part = repr(part).encode()
+        # Length prefixes keep ('ab', 'c') and ('a', 'bc') apart
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class RegisteredFaceCache:
+    """LRU cache of the LBPH histogram of each student's registered face.
+
+    The histogram is held inside a one-sample LBPH recognizer, so verifying a live
+    frame is a single `predict()` with exactly the same distance as before.
+    Entries are keyed by student id and checked against the content hash of the
+    registered image, so a changed image is never matched against a stale histogram.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # student_id -> (image hash, recognizer)
+        self.lock = threading.Lock()
+
+    def get(self, student_id, image_hash):
+        """Return the cached recognizer for this exact registered image, or None"""
+        with self.lock:
+            entry = self.entries.get(student_id)
+            if entry is None or entry[0] != image_hash:
+                return None
+            self.entries.move_to_end(student_id)
+            return entry[1]
+
+    def put(self, student_id, image_hash, face):
+        """Compute and cache the histogram of a cropped registered face"""
+        recognizer = cv2.face.LBPHFaceRecognizer_create()
+        recognizer.train([face], np.array([0]))
+        with self.lock:
+            self.entries[student_id] = (image_hash, recognizer)
+            self.entries.move_to_end(student_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return recognizer
+
+    def invalidate(self, student_id):
+        """Drop a student's entry, e.g. after they re-register"""
+        with self.lock:
+            self.entries.pop(student_id, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ResultCache:
+    """Short-lived LRU of (body, status) verification results, bounded in bytes.
+
+    Clients retry on network errors and capture components resend the same
+    frame, so an identical request within `ttl` seconds is answered without
+    decoding, detecting or predicting again. Keys come from request_key() over
+    the raw image and the other inputs. `generation` is the model version: a
+    lookup with a different one drops every entry and results computed with a
+    replaced model are not stored, so after a retrain or new enrollment nothing
+    is answered from the old model.
+    """
+
+    def __init__(self, ttl=RESULT_CACHE_TTL, max_bytes=RESULT_CACHE_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (expires, size, body, status)
+        self.size = 0
+        self.generation = None
+        self.lock = threading.Lock()
+
+    def get(self, key, generation=None):
+        """A copy of the cached (body, status) for key, or None"""
+        if self.ttl <= 0:
+            return None
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.size = 0
+                self.generation = generation
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self.size -= self.entries.pop(key)[1]
+                entry = None
+            if entry is None:
+                RESULT_CACHE_LOOKUPS.inc(result='miss')
+                return None
+            self.entries.move_to_end(key)
+        RESULT_CACHE_LOOKUPS.inc(result='hit')
+        # Callers add fields to the body (e.g. batch items), so never hand out the cached dict
+        return dict(entry[2]), entry[3]
+
+    def put(self, key, result, generation=None):
+        """Cache a (body, status) result computed with the given model generation"""
+        body, status = result
+        if self.ttl <= 0:
+            return
+        size = len(key) + len(json.dumps(body, default=str)) + RESULT_ENTRY_OVERHEAD
+        with self.lock:
+            if generation != self.generation:
+                # Computed with a model that has been replaced since the lookup
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (time.monotonic() + self.ttl, size, dict(body), status)
+            self.size += size
+            while self.size > self.max_bytes and self.entries:
+                self.size -= self.entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,194 @@
+"""Drop duplicate and redundant enrollment photos from a known_faces gallery.
+
+Every registration adds a `<student_id>_<timestamp>.jpg` sample, so re-enrolling
+students grow the gallery, the template store and every retrain without bound.
+Per student this keeps the registration image (`<student_id>.jpg`, which
+/verify-face falls back to), drops exact duplicates (same pixels after
+normalizing to FACE_SIZE) and near duplicates (difference hashes a few bits
+apart), and, above the per-student cap, keeps the newest sample plus the ones
+that are most different from each other (with a cap of 1, only the
+registration image). Then the template store is synced, which copies the
+surviving rows instead of extracting them again.
+
+    python face_compaction.py --dry-run
+    python face_compaction.py backend/known_faces --max-per-student 5 --archive removed_faces
+"""
+import argparse
+import hashlib
+import os
+import shutil
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+from face_gallery import chi_square, extract_histograms
+from face_model import FACE_SIZE, FaceModel, image_files, load_faces, student_id_from_filename
+from template_store import TemplateStore
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FACES_DIR = os.path.join(ROOT, 'backend', 'known_faces')
+MAX_SAMPLES_PER_STUDENT = int(os.environ.get('FACE_MAX_SAMPLES_PER_STUDENT', 5))
+# Difference hash bits two samples of a student may differ by and still be the same shot:
+# re-encoding or a few pixels of shift flip 0-4 bits, separate sessions 6 or more
+NEAR_DUPLICATE_BITS = int(os.environ.get('FACE_NEAR_DUPLICATE_BITS', 4))
+DHASH_SIZE = 8
+
+
+def dhash(face, size=DHASH_SIZE):
+    """64-bit difference hash: whether each pixel of a (size+1)xsize thumbnail is brighter than its left neighbour"""
+    small = cv2.resize(face, (size + 1, size), interpolation=cv2.INTER_AREA)
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), 'big')
+
+
+def fingerprints(faces):
+    """(content hash, difference hash) of normalized face crops"""
+    return [(hashlib.sha1(face.tobytes()).hexdigest(), dhash(face)) for face in faces]
+
+
+def is_reference(filename, student_id):
+    """`<student_id>.jpg` is the registration image /verify-face compares against; it is never removed"""
+    return os.path.splitext(filename)[0] == student_id
+
+
+def diverse_subset(histograms, seeds, count):
+    """Indices of count rows of histograms: the seeds, then farthest-point sampling by chi-square distance"""
+    selected = list(seeds)
+    row_sums = histograms.sum(axis=1)
+    nearest = np.min([chi_square(histograms, histograms[i], row_sums) for i in selected], axis=0)
+    nearest[selected] = -1
+    while len(selected) < min(count, len(histograms)):
+        candidate = int(np.argmax(nearest))
+        selected.append(candidate)
+        nearest = np.minimum(nearest, chi_square(histograms, histograms[candidate], row_sums))
+        nearest[candidate] = -1
+    return selected
+
+
+def plan_compaction(faces_dir, max_per_student=MAX_SAMPLES_PER_STUDENT, near_bits=NEAR_DUPLICATE_BITS,
+                    student_ids=None, label_for_file=student_id_from_filename, face_size=FACE_SIZE):
+    """Decide which samples to drop, without touching the directory.
+
+    Returns a dict with the `kept` filenames, the `removed` ones as
+    {file, student_id, reason, kept} (reason is duplicate, near_duplicate or
+    over_cap; kept names the sample that made it redundant) and the `unreadable`
+    files, which are left alone. student_ids limits the plan to those students.
+    """
+    by_student = defaultdict(list)
+    for filename in image_files(faces_dir):
+        student_id = label_for_file(filename)
+        if student_ids is None or student_id in student_ids:
+            by_student[student_id].append(filename)
+    chunks, unreadable = load_faces(faces_dir, [f for files in by_student.values() for f in files], face_size,
+                                    transform=fingerprints)
+    prints = {filename: fp for names, fps in chunks for filename, fp in zip(names, fps)}
+
+    kept_by_student = {}
+    removed = []
+    for student_id, files in sorted(by_student.items()):
+        # The registration image first, then the newest samples (timestamps sort in order)
+        files = [f for f in files if f in prints]
+        order = [f for f in files if is_reference(f, student_id)] + \
+                sorted((f for f in files if not is_reference(f, student_id)), reverse=True)
+        kept = []
+        for filename in order:
+            sha1, hashed = prints[filename]
+            match = next((k for k in kept if prints[k][0] == sha1), None)
+            reason = 'duplicate'
+            if match is None:
+                match = next((k for k in kept if bin(prints[k][1] ^ hashed).count('1') <= near_bits), None)
+                reason = 'near_duplicate'
+            if match is None or is_reference(filename, student_id):
+                kept.append(filename)
+            else:
+                removed.append({'file': filename, 'student_id': student_id, 'reason': reason, 'kept': match})
+        kept_by_student[student_id] = kept
+
+    over_cap = {s: kept for s, kept in kept_by_student.items() if len(kept) > max_per_student}
+    if over_cap:
+        chunks, _ = load_faces(faces_dir, [f for kept in over_cap.values() for f in kept], face_size,
+                               transform=extract_histograms)
+        histograms = {filename: h for names, matrix in chunks for filename, h in zip(names, matrix)}
+        for student_id, kept in over_cap.items():
+            kept = [f for f in kept if f in histograms]
+            # Keep the registration image, then the newest sample, as far as the cap allows
+            references = [i for i, f in enumerate(kept) if is_reference(f, student_id)]
+            newest = next((i for i, f in enumerate(kept) if not is_reference(f, student_id)), None)
+            seeds = (references + ([newest] if newest is not None else []))[:max_per_student]
+            chosen = set(diverse_subset(np.vstack([histograms[f] for f in kept]), seeds, max_per_student))
+            kept_by_student[student_id] = [f for i, f in enumerate(kept) if i in chosen]
+            removed += [{'file': f, 'student_id': student_id, 'reason': 'over_cap', 'kept': None}
+                        for i, f in enumerate(kept) if i not in chosen]
+
+    return {
+        'kept': sorted(f for kept in kept_by_student.values() for f in kept),
+        'removed': sorted(removed, key=lambda r: r['file']),
+        'unreadable': unreadable,
+    }
+
+
+def apply_compaction(faces_dir, plan, archive_dir=None):
+    """Delete the files a plan removes, or move them to archive_dir; returns how many were removed"""
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+    count = 0
+    for item in plan['removed']:
+        path = os.path.join(faces_dir, item['file'])
+        try:
+            if archive_dir:
+                shutil.move(path, os.path.join(archive_dir, item['file']))
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            # Already gone, e.g. removed by another compaction
+            continue
+        count += 1
+    return count
+
+
+def compact_gallery(template_store, max_per_student=MAX_SAMPLES_PER_STUDENT, near_bits=NEAR_DUPLICATE_BITS,
+                    student_ids=None, dry_run=False, archive_dir=None):
+    """Plan and apply a compaction of a template store's faces, then sync the store; returns the plan"""
+    plan = plan_compaction(template_store.faces_dir, max_per_student, near_bits, student_ids,
+                           template_store.label_for_file, template_store.face_size)
+    if not dry_run and plan['removed']:
+        apply_compaction(template_store.faces_dir, plan, archive_dir)
+        template_store.sync()
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('faces_dir', nargs='?', default=DEFAULT_FACES_DIR)
+    parser.add_argument('--max-per-student', type=int, default=MAX_SAMPLES_PER_STUDENT)
+    parser.add_argument('--near-bits', type=int, default=NEAR_DUPLICATE_BITS,
+                        help='difference hash bits within which two samples are near duplicates')
+    parser.add_argument('--student', action='append', dest='students', help='only compact these students')
+    parser.add_argument('--dry-run', action='store_true', help='only list what would be removed')
+    parser.add_argument('--archive', help='move removed samples here instead of deleting them')
+    parser.add_argument('--store', help='template store to sync afterwards (default: trained_model/templates '
+                                        'next to faces_dir, if it exists)')
+    parser.add_argument('--model-dir', help='also retrain the per-student LBPH model saved here')
+    args = parser.parse_args()
+    if args.max_per_student < 1:
+        parser.error('--max-per-student must be at least 1')
+
+    plan = plan_compaction(args.faces_dir, args.max_per_student, args.near_bits, args.students)
+    for item in plan['removed']:
+        detail = f" (same as {item['kept']})" if item['kept'] else ''
+        print(f"{'Would remove' if args.dry_run else 'Removing'} {item['file']}: {item['reason']}{detail}")
+    print(f"{len(plan['kept'])} samples kept, {len(plan['removed'])} removed")
+    if args.dry_run or not plan['removed']:
+        return
+
+    apply_compaction(args.faces_dir, plan, args.archive)
+    store_dir = args.store or os.path.join(os.path.dirname(os.path.abspath(args.faces_dir)), 'trained_model',
+                                           'templates')
+    if os.path.isdir(store_dir):
+        TemplateStore(store_dir, args.faces_dir).sync()
+    if args.model_dir:
+        FaceModel(args.faces_dir, model_dir=args.model_dir).train()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import os
+import queue
+
+import cv2
+import numpy as np
+
+FACE_SIZE = (200, 200)
+CASCADE_PATH = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+
+# Detection runs on a copy of the frame downscaled to this width; boxes are mapped
+# back to full resolution for cropping. Face size bounds are fractions of the frame
+# width and stop the cascade from scanning scales no real face can have.
+DETECTION_WIDTH = int(os.environ.get('FACE_DETECTION_WIDTH', 640))
+MIN_FACE_RATIO = float(os.environ.get('FACE_MIN_RATIO', 0.1))
+MAX_FACE_RATIO = float(os.environ.get('FACE_MAX_RATIO', 1.0))
+
+# A classroom snapshot holds many small faces, so it keeps more resolution
+CLASSROOM_DETECTION_WIDTH = int(os.environ.get('CLASSROOM_DETECTION_WIDTH', 1280))
+CLASSROOM_MIN_FACE_RATIO = float(os.environ.get('CLASSROOM_MIN_FACE_RATIO', 0.02))
+CLASSROOM_MAX_FACE_RATIO = float(os.environ.get('CLASSROOM_MAX_FACE_RATIO', 0.3))
+
+# The frontal face cascade is trained on 24x24 windows
+CASCADE_MIN_SIZE = 24
+
+# Client supplied boxes and crops are only sanity checked, never re-detected
+MIN_FACE_BOX = 40        # pixels, smaller boxes carry too little detail for LBPH
+MAX_BOX_ASPECT = 1.5     # face boxes are roughly square
+MIN_FACE_STDDEV = 8.0    # a flat crop (blank, covered camera) is not a face
+
+
+class FaceInputError(ValueError):
+    """A client supplied face box or face crop failed validation"""
+
+
+_cascade_pool = queue.SimpleQueue()
+
+
+def _borrow_cascade():
+    try:
+        return _cascade_pool.get_nowait()
+    except queue.Empty:
+        return cv2.CascadeClassifier(CASCADE_PATH)
+
+
+def detect_faces(gray, scale_factor=1.2, min_neighbors=5, working_width=None,
+                 min_face_ratio=None, max_face_ratio=None):
+    """Detect faces on a downscaled copy of a grayscale frame.
+
+    Returns an (n, 4) array of [x, y, w, h] boxes in full-resolution coordinates.
+    The classifier is borrowed from a pool, so threads never share one.
+    """
+    working_width = working_width or DETECTION_WIDTH
+    min_face_ratio = MIN_FACE_RATIO if min_face_ratio is None else min_face_ratio
+    max_face_ratio = MAX_FACE_RATIO if max_face_ratio is None else max_face_ratio
+
+    height, width = gray.shape[:2]
+    scale = min(1.0, working_width / float(width))
+    if scale < 1.0:
+        small = cv2.resize(gray, (int(round(width * scale)), int(round(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    else:
+        small = gray
+
+    small_width = small.shape[1]
+    min_side = max(CASCADE_MIN_SIZE, int(small_width * min_face_ratio))
+    max_side = max(min_side, int(min(small.shape[:2]) * max_face_ratio))
+
+    cascade = _borrow_cascade()
+    try:
+        boxes = cascade.detectMultiScale(small, scale_factor, min_neighbors,
+                                         minSize=(min_side, min_side), maxSize=(max_side, max_side))
+    finally:
+        _cascade_pool.put(cascade)
+
+    if len(boxes) == 0:
+        return np.empty((0, 4), dtype=int)
+    boxes = np.round(np.asarray(boxes, dtype=float) / scale).astype(int)
+    # Rounding can push a box a pixel past the frame edge
+    boxes[:, 2] = np.minimum(boxes[:, 2], width - boxes[:, 0])
+    boxes[:, 3] = np.minimum(boxes[:, 3], height - boxes[:, 1])
+    return boxes
+
+
+def detect_classroom_faces(gray, scale_factor=1.1, min_neighbors=5):
+    """Detect the many small faces of a classroom snapshot"""
+    return detect_faces(gray, scale_factor, min_neighbors, CLASSROOM_DETECTION_WIDTH,
+                        CLASSROOM_MIN_FACE_RATIO, CLASSROOM_MAX_FACE_RATIO)
+
+
+def _check_contrast(face):
+    if float(np.std(face)) < MIN_FACE_STDDEV:
+        raise FaceInputError('Face crop has no detail')
+    return face
+
+
+def parse_face_box(box, frame_shape):
+    """Validate a client supplied [x, y, w, h] box against the frame and return it as ints"""
+    if not isinstance(box, (list, tuple)) or len(box) != 4:
+        raise FaceInputError('face_box must be [x, y, width, height]')
+    try:
+        x, y, w, h = (int(round(float(v))) for v in box)
+    except (TypeError, ValueError):
+        raise FaceInputError('face_box values must be numbers')
+    height, width = frame_shape[:2]
+    if w < MIN_FACE_BOX or h < MIN_FACE_BOX:
+        raise FaceInputError(f'face_box is smaller than {MIN_FACE_BOX}px')
+    if max(w, h) > MAX_BOX_ASPECT * min(w, h):
+        raise FaceInputError('face_box is not roughly square')
+    if x < 0 or y < 0 or x + w > width or y + h > height:
+        raise FaceInputError('face_box lies outside the image')
+    return x, y, w, h
+
+
+def crop_face(gray, box, face_size=FACE_SIZE):
+    """Crop a validated box from a grayscale frame and resize it to face_size"""
+    x, y, w, h = box
+    return _check_contrast(cv2.resize(gray[y:y+h, x:x+w], face_size))
+
+
+def decode_face_crop(image_bytes, face_size=FACE_SIZE):
+    """Decode an already cropped and aligned face, which must be exactly face_size"""
+    face = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if face is None:
+        raise FaceInputError('Failed to decode face_image')
+    if (face.shape[1], face.shape[0]) != tuple(face_size):
+        raise FaceInputError(f'face_image must be {face_size[0]}x{face_size[1]} pixels')
+    return _check_contrast(face)
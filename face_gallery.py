@@ -0,0 +1,166 @@
+import numpy as np
+import cv2
+
+# Rows compared per step in chi-square matching, small enough for the chunk to stay in cache
+CHI_SQUARE_CHUNK = 64
+METRICS = ('chisqr', 'cosine')
+
+
+def extract_histograms(faces):
+    """LBPH spatial histograms of cropped faces as a float32 (n, d) matrix.
+
+    Uses OpenCV's own LBPH extraction (radius 1, 8 neighbours, 8x8 grid), so the
+    chi-square distance below equals the confidence `LBPHFaceRecognizer.predict()`
+    reports for the same pair of faces.
+    """
+    recognizer = cv2.face.LBPHFaceRecognizer_create()
+    recognizer.train(list(faces), np.arange(len(faces)))
+    return np.vstack([h.reshape(-1) for h in recognizer.getHistograms()]).astype(np.float32, copy=False)
+
+
+def histograms_from_recognizer(recognizer):
+    """(histograms, labels) already held by a trained LBPH recognizer"""
+    histograms = recognizer.getHistograms()
+    if not histograms:
+        return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.int32)
+    matrix = np.vstack([h.reshape(-1) for h in histograms]).astype(np.float32, copy=False)
+    return matrix, recognizer.getLabels().reshape(-1).astype(np.int32)
+
+
+def chi_square(matrix, probe, row_sums=None):
+    """Chi-square distance (OpenCV HISTCMP_CHISQR_ALT) from every row of matrix to probe.
+
+    Uses (a - b)^2 / (a + b) = a + b - 4ab / (a + b): the first two terms are row
+    sums, and the last is zero wherever the probe bin is empty, so only the probe's
+    non-empty bins (about a third of an LBP histogram) are ever read.
+    """
+    if row_sums is None:
+        row_sums = matrix.sum(axis=1)
+    cols = np.flatnonzero(probe)
+    values = probe[cols]
+    overlap = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), CHI_SQUARE_CHUNK):
+        rows = np.take(matrix[start:start + CHI_SQUARE_CHUNK], cols, axis=1)
+        total = rows + values
+        rows *= values
+        rows /= total
+        overlap[start:start + len(rows)] = rows.sum(axis=1)
+    return 2 * (row_sums + probe.sum() - 4 * overlap)
+
+
+class FaceGallery:
+    """Every enrolled LBP histogram in one contiguous float32 matrix.
+
+    Matching a probe is one vectorized pass over the matrix instead of a call per
+    template, and returns ranked candidates rather than only the best label.
+    Rows map to labels, labels to identities, so several enrollment photos of a
+    student (`22012021013_*.jpg`) can be aggregated into one candidate.
+
+    The matrix can be a read-only np.memmap; nothing here writes to it.
+    """
+
+    def __init__(self, histograms, labels, label_map, generation=0, sources=None):
+        self.histograms = histograms
+        self.generation = generation
+        # Optional (file, content hash) per row, so a subset can tell whether its rows changed
+        self.sources = sources
+        self.labels = np.asarray(labels, dtype=np.int32)
+        self.label_map = dict(label_map)
+        # Dense identity codes per row for the per-student reduction
+        self.identities = sorted(set(self.label_map.get(int(l)) for l in self.labels) - {None})
+        self.identity_index = {identity: i for i, identity in enumerate(self.identities)}
+        self.identity_codes = np.array([self.identity_index.get(self.label_map.get(int(l)), -1)
+                                        for l in self.labels], dtype=np.int64)
+        self._row_sums = None
+        self._norms = None
+
+    @classmethod
+    def from_model(cls, face_model):
+        """Build from the histograms a FaceModel's current snapshot already holds"""
+        snapshot = face_model.snapshot
+        parts = [histograms_from_recognizer(snapshot.recognizer)] if snapshot.recognizer is not None else []
+        if snapshot.recent is not None:
+            parts.append(snapshot.recent)
+        parts = [(h, l) for h, l in parts if len(l)]
+        if not parts:
+            return cls(np.empty((0, 0), dtype=np.float32), [], snapshot.label_map, snapshot.generation)
+        return cls(np.vstack([h for h, _ in parts]), np.concatenate([l for _, l in parts]), snapshot.label_map,
+                   snapshot.generation)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def rows_for(self, identities):
+        """Row indices of every template of the given identities"""
+        codes = [self.identity_index[i] for i in identities if i in self.identity_index]
+        return np.flatnonzero(np.isin(self.identity_codes, codes))
+
+    def subset(self, rows):
+        """A gallery of only the given rows, copied out of the (possibly memory-mapped) matrix"""
+        sources = [self.sources[r] for r in rows] if self.sources is not None else None
+        return FaceGallery(np.asarray(self.histograms[rows]), self.labels[rows], self.label_map, self.generation,
+                           sources)
+
+    def distances(self, probe, metric='chisqr'):
+        """Distance from a probe histogram to every template"""
+        if metric == 'chisqr':
+            if self._row_sums is None:
+                self._row_sums = self.histograms.sum(axis=1)
+            return chi_square(self.histograms, probe, self._row_sums)
+        if metric == 'cosine':
+            if self._norms is None:
+                self._norms = np.linalg.norm(self.histograms, axis=1)
+            norms = self._norms * max(float(np.linalg.norm(probe)), 1e-12)
+            return 1 - (self.histograms @ probe) / np.maximum(norms, 1e-12)
+        raise ValueError(f"metric must be one of {', '.join(METRICS)}")
+
+    def search(self, face, k=5, metric='chisqr', per_student=True):
+        """Return up to k (identity, distance) candidates for a cropped face, best first.
+
+        With per_student each identity appears once, at the distance of its
+        closest enrollment photo.
+        """
+        if len(self) == 0:
+            return []
+        return self.search_histogram(extract_histograms([face])[0], k, metric, per_student)
+
+    def search_histogram(self, probe, k=5, metric='chisqr', per_student=True):
+        """Like search(), for an already extracted probe histogram"""
+        if len(self) == 0:
+            return []
+        distances = self.distances(probe, metric)
+        if per_student:
+            best = np.full(len(self.identities), np.inf, dtype=np.float32)
+            known = self.identity_codes >= 0
+            np.minimum.at(best, self.identity_codes[known], distances[known])
+            name_of = self.identities.__getitem__
+        else:
+            best = distances
+            name_of = lambda row: self.label_map.get(int(self.labels[row]))
+        k = min(k, len(best))
+        top = np.argpartition(best, k - 1)[:k]
+        top = top[np.argsort(best[top])]
+        return [(name_of(i), float(best[i])) for i in top if np.isfinite(best[i])]
+
+    def identify_faces(self, gray, boxes, threshold, face_size):
+        """Same contract as FaceModel.identify_faces(), matched against this gallery"""
+        if len(boxes) == 0:
+            return [], 0
+        faces = [cv2.resize(gray[y:y+h, x:x+w], face_size) for (x, y, w, h) in boxes]
+        probes = extract_histograms(faces)
+        best = {}
+        unknown = 0
+        for (x, y, w, h), probe in zip(boxes, probes):
+            candidates = self.search_histogram(probe, 1)
+            if not candidates or candidates[0][1] >= threshold:
+                unknown += 1
+                continue
+            identity, distance = candidates[0]
+            if identity not in best or distance < best[identity]['confidence']:
+                best[identity] = {
+                    'student_id': identity,
+                    'confidence': distance,
+                    'box': [int(x), int(y), int(w), int(h)],
+                }
+        matches = sorted(best.values(), key=lambda m: m['confidence'])
+        return matches, unknown
@@ -0,0 +1,494 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from face_gallery import chi_square, extract_histograms
+from metrics import TRAIN_SECONDS
+
+FACE_SIZE = (200, 200)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# Bump when the on-disk model layout changes so old artifacts are retrained
+MODEL_FORMAT_VERSION = 1
+MODEL_FILE = 'recognizer.yml'
+MANIFEST_FILE = 'manifest.json'
+# Samples enrolled since the last full train are matched as a small histogram matrix
+# next to the recognizer; once this many pile up a background retrain folds them in
+MAX_PENDING_SAMPLES = 50
+# Seconds a scheduled retrain waits for further changes, so a burst of enrollments costs one rebuild
+RETRAIN_DELAY = float(os.environ.get('FACE_RETRAIN_DELAY', 1.0))
+# Gallery images are decoded on a thread pool (imread and resize release the GIL) in chunks
+LOAD_WORKERS = int(os.environ.get('FACE_LOAD_WORKERS', os.cpu_count() or 4))
+LOAD_CHUNK = 64
+# Galleries at least this large report loading progress
+PROGRESS_MIN_FILES = 1000
+
+
+def student_id_from_filename(filename):
+    """Map `<student_id>_<timestamp>.jpg` (or `<student_id>.jpg`) to the student id"""
+    return os.path.splitext(filename)[0].split('_')[0]
+
+
+def stem_from_filename(filename):
+    """Use the whole file name without extension as the identity"""
+    return os.path.splitext(filename)[0]
+
+
+def file_sha1(path):
+    """Content hash of a gallery image"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_entry(path, previous=None):
+    """Manifest entry for one file, reusing the old hash if mtime and size are unchanged"""
+    stat = os.stat(path)
+    entry = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+    if previous and previous['mtime_ns'] == entry['mtime_ns'] and previous['size'] == entry['size']:
+        entry['sha1'] = previous['sha1']
+    else:
+        entry['sha1'] = file_sha1(path)
+    return entry
+
+
+def image_files(faces_dir):
+    """Sorted names of the gallery images in a directory"""
+    with os.scandir(faces_dir) as entries:
+        return sorted(e.name for e in entries if e.name.lower().endswith(IMAGE_EXTENSIONS) and e.is_file())
+
+
+def read_face(path, face_size=FACE_SIZE):
+    """A gallery image as a grayscale face of face_size, None if it cannot be decoded"""
+    try:
+        img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    except cv2.error:
+        return None
+    if img is None or img.size == 0:
+        return None
+    return cv2.resize(img, tuple(face_size))
+
+
+def print_progress(done, total):
+    if total >= PROGRESS_MIN_FILES and (done == total or done % (LOAD_CHUNK * 16) == 0):
+        print(f"Loaded {done}/{total} face images")
+
+
+def _load_chunk(faces_dir, filenames, face_size, transform):
+    faces = []
+    kept = []
+    skipped = []
+    for filename in filenames:
+        face = read_face(os.path.join(faces_dir, filename), face_size)
+        if face is None:
+            skipped.append(filename)
+            continue
+        faces.append(face)
+        kept.append(filename)
+    return kept, transform(faces) if transform and faces else faces, skipped
+
+
+def load_faces(faces_dir, filenames, face_size=FACE_SIZE, transform=None, workers=None, chunk_size=LOAD_CHUNK,
+               progress=print_progress):
+    """Decode and resize gallery images on a thread pool, chunk by chunk.
+
+    Returns ([(kept filenames, faces), ...] per chunk in order, skipped filenames).
+    With transform each chunk's faces are replaced by transform(faces), computed
+    on the same worker (e.g. extract_histograms). Unreadable files are skipped and
+    reported instead of aborting the load.
+    """
+    workers = workers or LOAD_WORKERS
+    chunks = [filenames[i:i + chunk_size] for i in range(0, len(filenames), chunk_size)]
+    results = []
+    skipped = []
+    done = 0
+    pool = ThreadPoolExecutor(max_workers=min(workers, len(chunks))) if workers > 1 and len(chunks) > 1 else None
+    try:
+        loaded = (pool.map(_load_chunk, [faces_dir] * len(chunks), chunks, [face_size] * len(chunks),
+                           [transform] * len(chunks)) if pool else
+                  (_load_chunk(faces_dir, chunk, face_size, transform) for chunk in chunks))
+        for chunk, (kept, faces, bad) in zip(chunks, loaded):
+            results.append((kept, faces))
+            skipped += bad
+            done += len(chunk)
+            if progress:
+                progress(done, len(filenames))
+    finally:
+        if pool:
+            pool.shutdown()
+    if skipped:
+        listed = ', '.join(skipped[:10]) + (f' and {len(skipped) - 10} more' if len(skipped) > 10 else '')
+        print(f"Skipped {len(skipped)} unreadable face images: {listed}")
+    return results, skipped
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class ModelSnapshot:
+    """One published version of the model: recognizers plus the labels they were trained with.
+
+    Snapshots are never modified after they are published, so a reader that takes
+    `FaceModel.snapshot` once per request always sees a label map that matches the
+    recognizer. `recent` is (histograms, labels) of the samples enrolled since
+    `recognizer` was trained; their chi-square distance is the one LBPH reports.
+    """
+
+    def __init__(self, recognizer=None, label_map=None, file_labels=None, generation=0, recent=None):
+        self.recognizer = recognizer  # None until some faces were trained
+        self.recent = recent
+        self.label_map = label_map or {}      # label -> identity
+        self.file_labels = file_labels or {}  # filename -> label
+        self.generation = generation
+
+    def __len__(self):
+        return len(self.file_labels)
+
+    def labels_for(self, identity):
+        """All labels registered for an identity"""
+        return {label for label, name in self.label_map.items() if name == identity}
+
+    def predict(self, face):
+        """Return (label, identity, confidence) for a cropped face, (-1, None, inf) with nothing enrolled"""
+        label, confidence = -1, float('inf')
+        if self.recognizer is not None:
+            label, confidence = self.recognizer.predict(face)
+        if self.recent is not None:
+            histograms, labels = self.recent
+            distances = chi_square(histograms, extract_histograms([face])[0])
+            row = int(np.argmin(distances))
+            if distances[row] < confidence:
+                label, confidence = int(labels[row]), float(distances[row])
+        return label, self.label_map.get(label), confidence
+
+    def identify_faces(self, gray, boxes, threshold, face_size):
+        """Identify every detected face in a frame.
+
+        Returns (matches, unknown) where matches holds the best match per identity
+        as dicts with `student_id`, `confidence` and `box`, and unknown counts the
+        faces that matched nobody below the threshold.
+        """
+        best = {}
+        unknown = 0
+        for (x, y, w, h) in boxes:
+            face = cv2.resize(gray[y:y+h, x:x+w], face_size)
+            _, identity, confidence = self.predict(face)
+            if identity is None or confidence >= threshold:
+                unknown += 1
+                continue
+            if identity not in best or confidence < best[identity]['confidence']:
+                best[identity] = {
+                    'student_id': identity,
+                    'confidence': float(confidence),
+                    'box': [int(x), int(y), int(w), int(h)],
+                }
+        matches = sorted(best.values(), key=lambda m: m['confidence'])
+        return matches, unknown
+
+
+class FaceModel:
+    """LBPH recognizer together with the label bookkeeping for a known faces directory.
+
+    Readers never lock: every change builds a new `ModelSnapshot` off to the side
+    and swaps it in with one assignment. Enrolling a sample only computes its
+    histogram and adds it to the snapshot's recent samples, so it matches as soon
+    as `add_face()` returns. Full retrains (LBPH cannot forget, so replacing a
+    sample needs one, as do too many recent samples) run on a background thread
+    and coalesce: a burst of enrollments triggers one rebuild.
+
+    When `model_dir` is set the trained recognizer is persisted with a manifest of
+    the gallery (names, mtimes, sizes, hashes and labels), and a restart only
+    retrains if the gallery changed. Samples added since the last full write are
+    listed as pending in the manifest and loaded as recent samples.
+    """
+
+    def __init__(self, faces_dir, label_for_file=student_id_from_filename, face_size=FACE_SIZE,
+                 model_dir=None):
+        self.faces_dir = faces_dir
+        self.label_for_file = label_for_file
+        self.face_size = face_size
+        # Each label scheme gets its own artifact, so scripts sharing known_faces do not clobber each other
+        self.model_dir = os.path.join(model_dir, label_for_file.__name__) if model_dir else None
+        self.snapshot = ModelSnapshot()
+        self.recent = []  # (filename, label, histogram) enrolled since the last full train
+        self.manifest = None
+        self.lock = threading.Lock()        # serializes writers; readers only read self.snapshot
+        self.train_lock = threading.Lock()  # one full train at a time, so an older one never lands last
+        self.retrain_requested = threading.Event()
+        self._retrain_thread = None
+
+    # Views of the current snapshot; take `snapshot` once instead when using several
+    @property
+    def recognizer(self):
+        return self.snapshot.recognizer
+
+    @property
+    def label_map(self):
+        return self.snapshot.label_map
+
+    @property
+    def file_labels(self):
+        return self.snapshot.file_labels
+
+    @property
+    def generation(self):
+        # Bumped whenever the model changes, so derived caches know to rebuild
+        return self.snapshot.generation
+
+    def _image_files(self):
+        return image_files(self.faces_dir)
+
+    def _read_face(self, filename):
+        return read_face(os.path.join(self.faces_dir, filename), self.face_size)
+
+    def load_faces_and_labels(self, filenames=None):
+        """Read every registered face (or the given files) from disk, decoding in parallel"""
+        faces = []
+        labels = []
+        label_map = {}
+        file_labels = {}
+        chunks, _ = load_faces(self.faces_dir, self._image_files() if filenames is None else filenames,
+                               self.face_size)
+        for kept, chunk_faces in chunks:
+            for filename, img in zip(kept, chunk_faces):
+                label = len(file_labels)
+                faces.append(img)
+                labels.append(label)
+                label_map[label] = self.label_for_file(filename)
+                file_labels[filename] = label
+        return faces, labels, label_map, file_labels
+
+    def _publish(self, recognizer, file_labels, recent):
+        """Swap in a new snapshot (caller holds the lock)"""
+        matrix = None
+        if recent:
+            matrix = (np.vstack([h for _, _, h in recent]), np.array([label for _, label, _ in recent]))
+        label_map = {label: self.label_for_file(f) for f, label in file_labels.items()}
+        self.recent = recent
+        self.snapshot = ModelSnapshot(recognizer, label_map, file_labels, self.snapshot.generation + 1, matrix)
+
+    def train(self):
+        """Rebuild the recognizer from scratch with all registered faces and swap it in.
+
+        Faces are read and trained without holding the writer lock, so enrollments
+        carry on meanwhile; the ones the rebuild missed stay recent samples.
+        """
+        with self.train_lock, TRAIN_SECONDS.time(kind='full'):
+            filenames = self._image_files()
+            # Hashed before they are read: a file changed in between looks changed at the next start,
+            # and one added in between is not in the manifest, so the saved model is never trusted for it
+            entries = self._gallery_files((self.manifest or self._read_manifest() or {}).get('files', {}),
+                                          filenames)
+            faces, labels, _, file_labels = self.load_faces_and_labels(filenames)
+            recognizer = None
+            if faces:
+                recognizer = cv2.face.LBPHFaceRecognizer_create()
+                recognizer.train(faces, np.array(labels))
+            with self.lock:
+                recent = []
+                for filename, _, histogram in self.recent:
+                    if filename not in file_labels:
+                        file_labels[filename] = len(file_labels)
+                        recent.append((filename, file_labels[filename], histogram))
+                self._publish(recognizer, file_labels, recent)
+                self._save_full(entries)
+        if faces:
+            print(f"Recognizer trained with {len(faces)} faces")
+        return self.snapshot.label_map
+
+    def schedule_retrain(self):
+        """Retrain on the background thread; requests made before it starts are served by one rebuild"""
+        with self.lock:
+            self.retrain_requested.set()
+            if self._retrain_thread is None:
+                self._retrain_thread = threading.Thread(target=self._retrain_loop, name='face-model-retrain',
+                                                        daemon=True)
+                self._retrain_thread.start()
+
+    def _retrain_loop(self):
+        while True:
+            self.retrain_requested.wait()
+            # Let the rest of a burst arrive before paying for the rebuild
+            time.sleep(RETRAIN_DELAY)
+            self.retrain_requested.clear()
+            try:
+                self.train()
+            except Exception as e:
+                print(f"Background retrain failed: {str(e)}")
+
+    def add_face(self, filename, face):
+        """Save a face sample and make it matchable without retraining the rest.
+
+        Replacing a sample that is already in the main recognizer schedules a
+        background retrain; until it lands, the old and the new sample both match.
+        """
+        face = cv2.resize(face, self.face_size)
+        path = os.path.join(self.faces_dir, filename)
+        histogram = extract_histograms([face])[0]
+        with self.lock, TRAIN_SECONDS.time(kind='incremental'):
+            snapshot = self.snapshot
+            pending = {f for f, _, _ in self.recent}
+            replaces_trained = filename in snapshot.file_labels and filename not in pending
+            cv2.imwrite(path, face)
+            label = snapshot.file_labels.get(filename)
+            if label is None:
+                label = max(snapshot.label_map, default=-1) + 1
+            file_labels = dict(snapshot.file_labels)
+            file_labels[filename] = label
+            recent = [r for r in self.recent if r[0] != filename] + [(filename, label, histogram)]
+            self._publish(snapshot.recognizer, file_labels, recent)
+            if not replaces_trained:
+                # The saved model stays valid; a replaced sample leaves the manifest stale on purpose,
+                # so a restart before the retrain lands retrains from disk
+                self._save_incremental(filename)
+        if replaces_trained or len(recent) >= MAX_PENDING_SAMPLES:
+            self.schedule_retrain()
+        return self.snapshot.label_map
+
+    def remove_face(self, filename):
+        """Delete a face sample and rebuild the model without it"""
+        path = os.path.join(self.faces_dir, filename)
+        if os.path.exists(path):
+            os.remove(path)
+        return self.train()
+
+    def _manifest_header(self):
+        return {
+            'version': MODEL_FORMAT_VERSION,
+            'opencv': cv2.__version__,
+            'face_size': list(self.face_size),
+            'label_scheme': self.label_for_file.__name__,
+        }
+
+    def _read_manifest(self):
+        path = os.path.join(self.model_dir, MANIFEST_FILE)
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _gallery_files(self, previous, filenames):
+        return {
+            filename: file_entry(os.path.join(self.faces_dir, filename), previous.get(filename))
+            for filename in filenames
+        }
+
+    def _save_full(self, entries=None):
+        """Write the recognizer and a manifest listing the recent samples as pending (caller holds the lock).
+
+        entries are the manifest entries of the files the recognizer was trained
+        from; the manifest lists those plus the recent samples, never whatever else
+        has landed in the directory since.
+        """
+        if not self.model_dir:
+            return
+        os.makedirs(self.model_dir, exist_ok=True)
+        previous = (self.manifest or self._read_manifest() or {}).get('files', {})
+        manifest = self._manifest_header()
+        files = dict(entries or {})
+        for filename in self.snapshot.file_labels:
+            if filename not in files:
+                try:
+                    files[filename] = file_entry(os.path.join(self.faces_dir, filename), previous.get(filename))
+                except OSError:
+                    # Deleted since; the next start sees it gone and retrains
+                    continue
+        manifest['files'] = files
+        manifest['file_labels'] = dict(self.snapshot.file_labels)
+        manifest['pending'] = [filename for filename, _, _ in self.recent]
+        if self.snapshot.recognizer is not None:
+            model_path = os.path.join(self.model_dir, MODEL_FILE)
+            # FileStorage picks the format from the extension, so keep it on the temp file
+            tmp_path = os.path.join(self.model_dir, f"tmp_{MODEL_FILE}")
+            self.snapshot.recognizer.write(tmp_path)
+            os.replace(tmp_path, model_path)
+        # The manifest goes last so it never describes a model that is not on disk yet
+        _write_json_atomic(os.path.join(self.model_dir, MANIFEST_FILE), manifest)
+        self.manifest = manifest
+
+    def _save_incremental(self, filename):
+        """Record a recent sample without rewriting the model file (caller holds the lock)"""
+        if not self.model_dir:
+            return
+        if self.manifest is None:
+            return self._save_full()
+        self.manifest['files'][filename] = file_entry(os.path.join(self.faces_dir, filename))
+        self.manifest['file_labels'][filename] = self.snapshot.file_labels[filename]
+        if filename not in self.manifest['pending']:
+            self.manifest['pending'].append(filename)
+        _write_json_atomic(os.path.join(self.model_dir, MANIFEST_FILE), self.manifest)
+
+    def load(self):
+        """Load the persisted model if it still matches the gallery, return True on success"""
+        if not self.model_dir:
+            return False
+        manifest = self._read_manifest()
+        if not manifest or any(manifest.get(k) != v for k, v in self._manifest_header().items()):
+            return False
+
+        saved = manifest['files']
+        try:
+            current = {
+                filename: file_entry(os.path.join(self.faces_dir, filename), saved.get(filename))
+                for filename in self._image_files()
+            }
+        except OSError:
+            return False
+        if {f: e['sha1'] for f, e in current.items()} != {f: e['sha1'] for f, e in saved.items()}:
+            print("Known faces changed since the recognizer was saved, retraining")
+            return False
+
+        file_labels = manifest['file_labels']
+        pending = list(dict.fromkeys(manifest['pending']))
+        recognizer = None
+        recent = []
+        try:
+            if len(file_labels) > len(pending):
+                recognizer = cv2.face.LBPHFaceRecognizer_create()
+                recognizer.read(os.path.join(self.model_dir, MODEL_FILE))
+            faces = [self._read_face(filename) for filename in pending]
+            if any(face is None for face in faces):
+                return False
+            if faces:
+                recent = [(filename, file_labels[filename], histogram)
+                          for filename, histogram in zip(pending, extract_histograms(faces))]
+        except cv2.error:
+            return False
+
+        with self.lock:
+            manifest['files'] = current
+            self.manifest = manifest
+            self._publish(recognizer, dict(file_labels), recent)
+        print(f"Loaded recognizer with {len(file_labels)} faces from {self.model_dir}")
+        return True
+
+    def load_or_train(self):
+        """Warm start from the persisted model, retraining only when the gallery changed"""
+        if not self.load():
+            self.train()
+        return self.label_map
+
+    def labels_for(self, identity):
+        """All labels registered for an identity"""
+        return self.snapshot.labels_for(identity)
+
+    def predict(self, face):
+        """Return (label, identity, confidence) for a cropped face"""
+        return self.snapshot.predict(face)
+
+    def identify_faces(self, gray, boxes, threshold):
+        """Identify every detected face in a frame, see ModelSnapshot.identify_faces()"""
+        return self.snapshot.identify_faces(gray, boxes, threshold, self.face_size)
@@ -0,0 +1,102 @@
+import os
+import queue
+
+import cv2
+
+from face_detection import MIN_FACE_RATIO
+from metrics import QUALITY_THRESHOLDS, REJECTIONS, STAGE_SECONDS
+
+# Cheap checks on the FACE_SIZE crop that turn away frames LBPH would only fail
+# on after a full predict. They run cheapest first and stop at the first failure;
+# all of them together cost well under a millisecond, a fraction of a predict.
+QUALITY_GATE = os.environ.get('FACE_QUALITY_GATE', '1') != '0'
+# Variance of the Laplacian of the crop shrunk to SHARPNESS_SIZE, so a small face
+# upsampled to FACE_SIZE is not mistaken for a blurred one; sharp frames score
+# 100-600, motion or focus blur under 50
+MIN_SHARPNESS = float(os.environ.get('FACE_MIN_SHARPNESS', 60))
+SHARPNESS_SIZE = (64, 64)
+# Mean and standard deviation of the gray levels
+MIN_BRIGHTNESS = float(os.environ.get('FACE_MIN_BRIGHTNESS', 40))
+MAX_BRIGHTNESS = float(os.environ.get('FACE_MAX_BRIGHTNESS', 220))
+MIN_CONTRAST = float(os.environ.get('FACE_MIN_CONTRAST', 15))
+# Face box width as a fraction of the frame width, for client supplied boxes
+MIN_FRAME_RATIO = float(os.environ.get('FACE_QUALITY_MIN_RATIO', MIN_FACE_RATIO))
+# The eye cascade costs 2-4 ms and misses some real faces, so it is opt-in
+REQUIRE_EYES = os.environ.get('FACE_REQUIRE_EYES', '0') != '0'
+EYE_CASCADE_PATH = cv2.data.haarcascades + 'haarcascade_eye.xml'
+# Eyes are searched in this band of the face crop (fractions of its height), downscaled to EYE_BAND_SIZE
+EYE_BAND = (0.1, 0.6)
+EYE_BAND_SIZE = (100, 50)
+
+QUALITY_MESSAGES = {
+    'face_too_small': 'Face is too small in the frame, move closer to the camera',
+    'too_dark': 'Face is too dark, improve the lighting',
+    'too_bright': 'Face is overexposed, reduce the lighting',
+    'low_contrast': 'Face has too little contrast',
+    'blurry': 'Face is blurry, hold the camera still',
+    'eyes_not_found': 'Eyes are not visible, look at the camera',
+}
+
+for _check, _value in (('min_sharpness', MIN_SHARPNESS), ('min_brightness', MIN_BRIGHTNESS),
+                       ('max_brightness', MAX_BRIGHTNESS), ('min_contrast', MIN_CONTRAST),
+                       ('min_frame_ratio', MIN_FRAME_RATIO), ('require_eyes', int(REQUIRE_EYES)),
+                       ('enabled', int(QUALITY_GATE))):
+    QUALITY_THRESHOLDS.set(_value, check=_check)
+
+# Like the face cascades, eye classifiers are borrowed from a pool so threads never share one
+_eye_cascade_pool = queue.SimpleQueue()
+
+
+def _eyes_visible(face):
+    height = face.shape[0]
+    band = cv2.resize(face[int(height * EYE_BAND[0]):int(height * EYE_BAND[1])], EYE_BAND_SIZE,
+                      interpolation=cv2.INTER_AREA)
+    try:
+        cascade = _eye_cascade_pool.get_nowait()
+    except queue.Empty:
+        cascade = cv2.CascadeClassifier(EYE_CASCADE_PATH)
+    try:
+        eyes = cascade.detectMultiScale(band, 1.2, 3, minSize=(12, 12))
+    finally:
+        _eye_cascade_pool.put(cascade)
+    return len(eyes) > 0
+
+
+def assess_face(face, frame_ratio=None):
+    """Reason code of the first quality check a FACE_SIZE grayscale crop fails, None if usable.
+
+    frame_ratio is the face box width over the frame width, when there was a frame.
+    """
+    if frame_ratio is not None and frame_ratio < MIN_FRAME_RATIO:
+        return 'face_too_small'
+    mean, stddev = cv2.meanStdDev(face)
+    if mean[0, 0] < MIN_BRIGHTNESS:
+        return 'too_dark'
+    if mean[0, 0] > MAX_BRIGHTNESS:
+        return 'too_bright'
+    if stddev[0, 0] < MIN_CONTRAST:
+        return 'low_contrast'
+    small = cv2.resize(face, SHARPNESS_SIZE, interpolation=cv2.INTER_AREA)
+    # The 3x3 Laplacian of 8-bit pixels fits in int16, which is faster than float
+    _, sharpness = cv2.meanStdDev(cv2.Laplacian(small, cv2.CV_16S))
+    if sharpness[0, 0] ** 2 < MIN_SHARPNESS:
+        return 'blurry'
+    if REQUIRE_EYES and not _eyes_visible(face):
+        return 'eyes_not_found'
+    return None
+
+
+def check_face(face, frame_ratio=None):
+    """assess_face() timed as the `quality` stage, counting rejections by reason"""
+    if not QUALITY_GATE:
+        return None
+    with STAGE_SECONDS.time(stage='quality'):
+        reason = assess_face(face, frame_ratio)
+    if reason:
+        REJECTIONS.inc(reason=reason)
+    return reason
+
+
+def quality_error(reason):
+    """Response body for a rejected face; `code` lets clients tell the user what to fix"""
+    return {'error': QUALITY_MESSAGES[reason], 'code': reason}
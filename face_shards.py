@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from face_model import _write_json_atomic
+from metrics import SHARD_LOOKUPS
+
+ROSTER_FILE = 'rosters.json'
+# Shards kept in memory; each holds a copy of its rows (64 KB per enrollment photo)
+MAX_SHARDS = int(os.environ.get('FACE_MAX_SHARDS', 64))
+
+
+def parse_id_list(value):
+    """Class groups or student ids from a JSON list or a comma separated string"""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, (list, tuple, set)):
+        raise ValueError('expected a list or a comma separated string')
+    return sorted({str(v).strip() for v in value if str(v).strip()})
+
+
+class RosterStore:
+    """Which students belong to which class group, shared by every worker process.
+
+    Kept as `rosters.json` next to the template store and written under the
+    store's lock with an atomic replace; readers reload it when its stat changes.
+    """
+
+    def __init__(self, template_store):
+        self.template_store = template_store
+        self.path = os.path.join(template_store.store_dir, ROSTER_FILE)
+        self._loaded = (None, {})  # (stat key, {group: sorted student ids})
+
+    def _key(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_ino, stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def rosters(self):
+        """{class group: [student ids]} as last written by any worker"""
+        key = self._key()
+        loaded = self._loaded
+        if loaded[0] == key:
+            return loaded[1]
+        rosters = {}
+        if key:
+            try:
+                with open(self.path) as f:
+                    rosters = json.load(f)
+            except (OSError, ValueError):
+                rosters = {}
+        self._loaded = (key, rosters)
+        return rosters
+
+    def students(self, groups):
+        """Every student in any of the groups"""
+        rosters = self.rosters()
+        return {student for group in groups for student in rosters.get(group, [])}
+
+    def _update(self, change):
+        with self.template_store._write_lock():
+            rosters = dict(self.rosters())
+            change(rosters)
+            _write_json_atomic(self.path, rosters)
+            self._loaded = (self._key(), rosters)
+        return rosters
+
+    def add(self, group, student_id):
+        """Put a student in a class group, out of any group they were in before"""
+        student_id = str(student_id)
+        if student_id in self.rosters().get(group, []):
+            return
+
+        def change(rosters):
+            for name, members in list(rosters.items()):
+                if student_id in members and name != group:
+                    rosters[name] = [s for s in members if s != student_id]
+            rosters[group] = sorted(set(rosters.get(group, [])) | {student_id})
+        self._update(change)
+
+    def set_roster(self, group, student_ids):
+        """Replace the members of a class group"""
+        def change(rosters):
+            rosters[group] = sorted(student_ids)
+        self._update(change)
+
+
+def same_templates(shard, source, rows):
+    """True if rows of source come from the same files, with the same content, in the same order as shard.
+
+    Decided from the store index (file name and content hash per row), so no
+    histogram is read from the memory map.
+    """
+    if shard.sources is None or source.sources is None or len(rows) != len(shard):
+        return False
+    return [source.sources[r] for r in rows] == shard.sources
+
+
+class ShardCache:
+    """LRU of per class group (or per lecture roster) galleries cut from the template store.
+
+    A shard holds only the rows of its students, so identification scans the
+    roster instead of the institution and cannot match anyone outside it. Shards
+    are built lazily on first use. When the store publishes a new generation a
+    shard is only rebuilt if its own templates changed, so enrolling a student in
+    one group leaves every other group's shard (and its cached norms) untouched,
+    even when the store rewrite moved its rows.
+    """
+
+    def __init__(self, template_store, rosters, max_shards=MAX_SHARDS):
+        self.template_store = template_store
+        self.rosters = rosters
+        self.max_shards = max_shards
+        self.shards = OrderedDict()  # key -> (source gallery, students, shard gallery)
+        self.lock = threading.Lock()
+
+    def gallery(self, groups=(), student_ids=()):
+        """The gallery restricted to the students of groups, or to an explicit roster of student ids"""
+        if student_ids:
+            students = frozenset(student_ids)
+            key = 'roster:' + hashlib.sha1(','.join(sorted(students)).encode()).hexdigest()
+        else:
+            students = frozenset(self.rosters.students(groups))
+            key = 'groups:' + ','.join(sorted(groups))
+        source = self.template_store.gallery()
+        with self.lock:
+            entry = self.shards.get(key)
+            if entry is not None:
+                self.shards.move_to_end(key)
+        if entry is not None and entry[1] == students and entry[0] is source:
+            SHARD_LOOKUPS.inc(result='hit')
+            return entry[2]
+        rows = source.rows_for(students)
+        if entry is not None and entry[1] == students and same_templates(entry[2], source, rows):
+            # The store changed, but not for this roster
+            SHARD_LOOKUPS.inc(result='reused')
+            self._put(key, (source, students, entry[2]))
+            return entry[2]
+        SHARD_LOOKUPS.inc(result='built')
+        shard = source.subset(rows)
+        self._put(key, (source, students, shard))
+        return shard
+
+    def _put(self, key, entry):
+        with self.lock:
+            self.shards[key] = entry
+            self.shards.move_to_end(key)
+            while len(self.shards) > self.max_shards:
+                self.shards.popitem(last=False)
@@ -0,0 +1,175 @@
+import itertools
+import threading
+from collections import Counter, deque
+
+# Boxes in consecutive frames belong to the same face if they overlap this much
+IOU_THRESHOLD = 0.3
+# ...or, failing that, if their centres are within this fraction of the box width
+CENTROID_DISTANCE_RATIO = 0.5
+# A track is forgotten after this many frames without a matching detection
+MAX_MISSED_FRAMES = 10
+# Re-check a decided identity every N frames in case the person changed
+RECOGNIZE_EVERY = 30
+# Predictions kept per track, and how many must agree before an identity is accepted
+VOTE_WINDOW = 5
+VOTES_NEEDED = 3
+
+
+def iou(a, b):
+    """Intersection over union of two [x, y, w, h] boxes"""
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    ix = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    iy = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = ix * iy
+    union = aw * ah + bw * bh - inter
+    return inter / union if union else 0.0
+
+
+def centroid_close(a, b, ratio=CENTROID_DISTANCE_RATIO):
+    """Whether the centres of two boxes are within ratio * the larger width"""
+    ax, ay = a[0] + a[2] / 2, a[1] + a[3] / 2
+    bx, by = b[0] + b[2] / 2, b[1] + b[3] / 2
+    limit = ratio * max(a[2], b[2])
+    return (ax - bx) ** 2 + (ay - by) ** 2 <= limit ** 2
+
+
+class Track:
+    """One face followed across frames, with the recent predictions made for it"""
+
+    def __init__(self, track_id, box, vote_window=VOTE_WINDOW):
+        self.id = track_id
+        self.box = tuple(box)
+        self.missed = 0
+        self.since_recognition = None  # frames since the last prediction, None before the first
+        self.votes = deque(maxlen=vote_window)  # (identity or None, confidence)
+        self.identity = None
+        self.confidence = None
+        self.marked = set()  # identities already reported for this track
+
+    def needs_recognition(self, recognize_every):
+        if self.since_recognition is None:
+            return True
+        if self.identity is None:
+            # Keep predicting until enough votes agree, but give up on unknown faces
+            # for a while once the window is full
+            return len(self.votes) < self.votes.maxlen or self.since_recognition >= recognize_every
+        return self.since_recognition >= recognize_every
+
+    def vote(self, identity, confidence, votes_needed):
+        self.since_recognition = 0
+        self.votes.append((identity, confidence))
+        counts = Counter(name for name, _ in self.votes if name is not None)
+        if counts:
+            name, count = counts.most_common(1)[0]
+            if count >= votes_needed:
+                self.identity = name
+                self.confidence = sum(c for n, c in self.votes if n == name) / count
+                return
+        self.identity = None
+        self.confidence = None
+
+
+class FaceTracker:
+    """Associates detections between frames so each face is only recognized now and then.
+
+    `update(boxes)` matches the boxes of a new frame to existing tracks (greedy by
+    IoU, then by centroid distance), starts tracks for unmatched boxes and returns
+    the current tracks plus those that need a prediction. Predictions are fed back
+    with `vote()`; an identity is only accepted once `votes_needed` of the last
+    `vote_window` predictions agree.
+    """
+
+    def __init__(self, iou_threshold=IOU_THRESHOLD, max_missed=MAX_MISSED_FRAMES,
+                 recognize_every=RECOGNIZE_EVERY, vote_window=VOTE_WINDOW, votes_needed=VOTES_NEEDED):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.recognize_every = recognize_every
+        self.vote_window = vote_window
+        self.votes_needed = votes_needed
+        self.tracks = {}
+        self.ids = itertools.count(1)
+        self.frames = 0
+        self.detections = 0
+        self.predictions = 0
+        self.created = 0
+        self.out_of_order = 0
+        self.last_frame = None
+        self.lock = threading.Lock()
+
+    def _associate(self, boxes):
+        """Return {box index: track} for detections that continue an existing track"""
+        pairs = []
+        for i, box in enumerate(boxes):
+            for track in self.tracks.values():
+                overlap = iou(box, track.box)
+                if overlap >= self.iou_threshold:
+                    pairs.append((overlap, i, track))
+                elif centroid_close(box, track.box):
+                    # Fast movement can break the overlap; rank below every IoU match
+                    pairs.append((-1.0, i, track))
+        matched = {}
+        used = set()
+        for _, i, track in sorted(pairs, key=lambda p: p[0], reverse=True):
+            if i in matched or track.id in used:
+                continue
+            matched[i] = track
+            used.add(track.id)
+        return matched
+
+    def update(self, boxes, frame_index=None):
+        """Advance one frame, return (visible tracks, tracks to recognize).
+
+        Workers can finish frames out of order. A frame older than the last one
+        applied does not move the tracks back in time; it gets the current tracks
+        and nothing to recognize.
+        """
+        boxes = [tuple(int(v) for v in box) for box in boxes]
+        with self.lock:
+            if frame_index is not None:
+                if self.last_frame is not None and frame_index <= self.last_frame:
+                    self.out_of_order += 1
+                    return [t for t in self.tracks.values() if t.missed == 0], []
+                self.last_frame = frame_index
+            self.frames += 1
+            self.detections += len(boxes)
+            matched = self._associate(boxes)
+            for track in self.tracks.values():
+                track.missed += 1
+                if track.since_recognition is not None:
+                    track.since_recognition += 1
+            visible = []
+            for i, box in enumerate(boxes):
+                track = matched.get(i)
+                if track is None:
+                    track = Track(next(self.ids), box, self.vote_window)
+                    self.created += 1
+                    self.tracks[track.id] = track
+                track.box = box
+                track.missed = 0
+                visible.append(track)
+            for track_id in [t.id for t in self.tracks.values() if t.missed > self.max_missed]:
+                del self.tracks[track_id]
+            to_recognize = [t for t in visible if t.needs_recognition(self.recognize_every)]
+            for track in to_recognize:
+                # Claim the prediction now so another worker does not repeat it
+                track.since_recognition = 0
+            return visible, to_recognize
+
+    def vote(self, track, identity, confidence):
+        """Record a prediction for a track; return the identity the first time one is accepted for it, else None.
+
+        Callers must use the returned identity, not track.identity, which another worker's vote can change.
+        """
+        with self.lock:
+            self.predictions += 1
+            track.vote(identity, confidence, self.votes_needed)
+            accepted = track.identity
+            if accepted is not None and accepted not in track.marked:
+                track.marked.add(accepted)
+                return accepted
+            return None
+
+    def summary(self):
+        return (f"frames={self.frames} detections={self.detections} predictions={self.predictions} "
+                f"tracks={self.created} out_of_order={self.out_of_order}")
@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import cv2
 import numpy as np
@@ -8,30 +8,57 @@ from PIL import Image
 import io
 import logging
 import traceback
+import atexit
 import datetime
 import csv
+import json
+from concurrent.futures import ThreadPoolExecutor
+from face_cache import ResultCache, request_key
+from face_model import FaceModel, stem_from_filename
+from face_quality import check_face, quality_error
+from attendance_store import AttendanceStore, AttendanceWriter
+from image_io import decode_gray_for_faces, image_bytes, request_fields, scale_box
+from face_detection import (CLASSROOM_DETECTION_WIDTH, CLASSROOM_MIN_FACE_RATIO, FaceInputError, crop_face,
+                            decode_face_crop, detect_classroom_faces, detect_faces, parse_face_box)
+from metrics import (CONFIDENCE, CONTENT_TYPE, GALLERY_SIZE, REGISTRY, REJECTIONS, STAGE_SECONDS,
+                     instrument_flask)
 
 app = Flask(__name__)
 CORS(app)
+instrument_flask(app)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize face detector
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-
 # Configuration
 ATTENDANCE_THRESHOLD = 0.4  # Lower is more strict (cosine distance)
 ATTENDANCE_FILE = 'attendance.csv'
+ATTENDANCE_PAGE_SIZE = 100
+ATTENDANCE_MAX_PAGE_SIZE = 1000
 KNOWN_FACES_FOLDER = 'known_faces'
+MODEL_DIR = 'trained_model'
 TEMP_IMAGE_PREFIX = 'temp_verify_'
 CASCADE_PATH = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
 FACE_SIZE = (200, 200)
+VERIFY_THRESHOLD = 60  # Lower is stricter
+MAX_BATCH_SIZE = 200
+BATCH_WORKERS = os.cpu_count() or 4
+# Verdicts and rejections of the frame itself are cached; server errors are not
+CACHED_STATUSES = (200, 400)
 
 # Ensure directories exist
 os.makedirs(KNOWN_FACES_FOLDER, exist_ok=True)
 
+# Same-day duplicate checks go through an in-memory index instead of rescanning the CSV
+attendance_store = AttendanceStore(ATTENDANCE_FILE)
+# Marks are appended in batches on a background thread; close() writes out the rest on exit
+attendance_writer = AttendanceWriter(attendance_store)
+atexit.register(attendance_writer.close)
+
+# OpenCV releases the GIL while detecting and predicting, so batch items run on threads
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
 class FaceVerificationError(Exception):
     pass
 
@@ -50,7 +77,7 @@ def detect_face(image):
     """Detect face in image using OpenCV"""
     try:
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+        faces = detect_faces(gray, 1.3, 5)
         if len(faces) == 0:
             return None
         (x, y, w, h) = faces[0]
@@ -106,142 +133,284 @@ def cleanup_files(file_paths):
             logger.error(f"Error removing file {file_path}: {str(e)}")
 
 def mark_attendance(name, status="Present"):
-    """Record attendance in CSV file"""
-    now = datetime.datetime.now()
-    date_str = now.strftime("%Y-%m-%d")
-    time_str = now.strftime("%H:%M:%S")
-    
-    # Check if attendance already recorded today
-    if os.path.exists(ATTENDANCE_FILE):
-        with open(ATTENDANCE_FILE, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(row) >= 4 and row[0] == name and row[1] == date_str:
-                    return False  # Already marked
-    
-    # Record attendance
-    with open(ATTENDANCE_FILE, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([name, date_str, time_str, status])
-    return True
+    """Queue attendance for the CSV file, False if already marked today"""
+    return attendance_writer.mark(name, status)
 
 # Helper to load all faces and labels
 def load_faces_and_labels():
-    faces = []
-    labels = []
-    label_map = {}
-    for idx, filename in enumerate(os.listdir(KNOWN_FACES_FOLDER)):
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-            path = os.path.join(KNOWN_FACES_FOLDER, filename)
-            img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
-            if img is None:
-                continue
-            faces.append(img)
-            labels.append(idx)
-            label_map[idx] = filename.split('.')[0]
+    faces, labels, label_map, _ = face_model.load_faces_and_labels()
     return faces, labels, label_map
 
 # Train recognizer
 def train_recognizer():
-    faces, labels, label_map = load_faces_and_labels()
-    if len(faces) > 0:
-        recognizer.train(faces, np.array(labels))
-    return label_map
+    return face_model.train()
 
 # Initialize recognizer before training
-recognizer = cv2.face.LBPHFaceRecognizer_create()
-label_map = train_recognizer()
+face_model = FaceModel(KNOWN_FACES_FOLDER, label_for_file=stem_from_filename, face_size=FACE_SIZE,
+                       model_dir=MODEL_DIR)
+face_model.load_or_train()
+GALLERY_SIZE.set_function(lambda: len(face_model.file_labels))
+# Keyed by the request and checked against the snapshot generation, so retrains invalidate it
+verify_results = ResultCache()
 
 # Helper to detect and crop face
 def detect_and_crop_face(image):
-    faces = face_cascade.detectMultiScale(image, scaleFactor=1.1, minNeighbors=5)
+    with STAGE_SECONDS.time(stage='detect'):
+        faces = detect_faces(image, 1.1, 5)
     if len(faces) == 0:
-        return None
+        return None, None
     x, y, w, h = faces[0]
     face = image[y:y+h, x:x+w]
     face = cv2.resize(face, FACE_SIZE)
-    return face
+    return face, w / image.shape[1]
+
+def request_face(image=None, face_box=None, face_image=None):
+    """Cropped face for a request, skipping the full-frame cascade when the client sent a crop or a box.
+
+    Returns (face, face width over frame width); the ratio is None for a client
+    crop and face is None when no face was detected. Raises FaceInputError for
+    an invalid box or crop.
+    """
+    if face_image:
+        with STAGE_SECONDS.time(stage='decode'):
+            return decode_face_crop(image_bytes(face_image), FACE_SIZE), None
+
+    # Large JPEGs are decoded at reduced scale straight to grayscale
+    with STAGE_SECONDS.time(stage='decode'):
+        image, scale = decode_gray_for_faces(image_bytes(image))
+    if image is None:
+        raise FaceInputError('Failed to decode image')
+    if face_box is not None:
+        box = parse_face_box(scale_box(face_box, scale), image.shape)
+        return crop_face(image, box, FACE_SIZE), box[2] / image.shape[1]
+    return detect_and_crop_face(image)
+
+def verify_student(student_id, image, face_box=None, face_image=None):
+    """Verify a data URL image against the trained model for one student, returning (body, status)"""
+    # Labels and prediction come from one snapshot, so a retrain swapping in new labels cannot split them
+    model = face_model.snapshot
+    # A retried or resent frame gets the verdict computed for it a moment ago, unless the model changed
+    result_key = request_key(student_id, image, face_box, face_image)
+    cached = verify_results.get(result_key, model.generation)
+    if cached is not None:
+        return cached
+    result = verify_with_model(model, student_id, image, face_box, face_image)
+    if result[1] in CACHED_STATUSES:
+        verify_results.put(result_key, result, model.generation)
+    return result
+
+def verify_with_model(model, student_id, image, face_box=None, face_image=None):
+    """verify_student() against one model snapshot"""
+    try:
+        face, frame_ratio = request_face(image, face_box, face_image)
+    except FaceInputError as e:
+        REJECTIONS.inc(reason='invalid_input')
+        return {'error': str(e)}, 400
+    if face is None:
+        REJECTIONS.inc(reason='no_face')
+        return {'error': 'No face detected'}, 400
+    # Rejecting a blurry or dark frame here is cheaper than the predict it would fail
+    reason = check_face(face, frame_ratio)
+    if reason:
+        return quality_error(reason), 400
+
+    labels = model.labels_for(student_id)
+    if not labels:
+        return {'error': 'No registered face for this student'}, 404
+
+    with STAGE_SECONDS.time(stage='predict'):
+        pred_label, _, confidence = model.predict(face)
+    CONFIDENCE.observe(confidence)
+    if pred_label in labels and confidence < VERIFY_THRESHOLD:
+        return {'success': True, 'verified': True, 'confidence': float(confidence)}, 200
+    else:
+        return {'success': True, 'verified': False, 'confidence': float(confidence)}, 200
 
 @app.route('/verify', methods=['POST'])
 def verify_face():
+    try:
+        # JSON with base64 images, multipart uploads or a raw octet-stream body
+        data = request_fields(request, ('image', 'face_image'))
+        if not data or not (data.get('image') or data.get('face_image')) or 'student_id' not in data:
+            return jsonify({'error': 'Missing required data'}), 400
+
+        body, status = verify_student(data['student_id'], data.get('image'),
+                                      data.get('face_box'), data.get('face_image'))
+        return jsonify(body), status
+    except Exception as e:
+        logger.error(f"Error in verify_face: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def verify_batch_item(item):
+    """Run one /verify-batch item, turning failures into a per-item error"""
+    student_id = item.get('student_id')
+    if not student_id or not (item.get('image') or item.get('face_image')):
+        body, status = {'error': 'Missing required data'}, 400
+    else:
+        try:
+            body, status = verify_student(student_id, item.get('image'),
+                                          item.get('face_box'), item.get('face_image'))
+        except Exception as e:
+            logger.error(f"Error verifying batch item for {student_id}: {str(e)}")
+            body, status = {'error': str(e)}, 500
+    body.setdefault('success', False)
+    body.setdefault('verified', False)
+    body.update({'student_id': student_id, 'status': status})
+    return body
+
+@app.route('/verify-batch', methods=['POST'])
+def verify_batch():
+    """Verify many (student_id, image) pairs in one request"""
     try:
         data = request.get_json()
-        if not data or 'image' not in data or 'student_id' not in data:
+        items = data.get('items') if data else None
+        if not isinstance(items, list) or not items:
             return jsonify({'error': 'Missing required data'}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'Too many items, at most {MAX_BATCH_SIZE} per batch'}), 413
+        if not all(isinstance(item, dict) for item in items):
+            return jsonify({'error': 'Each item must be an object'}), 400
 
-        # Decode base64 image
-        image_data = base64.b64decode(data['image'].split(',')[1])
-        image = Image.open(io.BytesIO(image_data)).convert('L')
-        image = np.array(image)
+        results = list(batch_executor.map(verify_batch_item, items))
+        return jsonify({
+            'success': True,
+            'verified': sum(1 for r in results if r['verified']),
+            'results': results
+        })
+    except Exception as e:
+        logger.error(f"Error in verify_batch: {str(e)}")
+        return jsonify({'error': str(e)}), 500
 
-        # Detect and crop face
-        face = detect_and_crop_face(image)
-        if face is None:
+@app.route('/recognize-classroom', methods=['POST'])
+def recognize_classroom():
+    """Identify every face in one classroom frame and mark all recognized students present"""
+    try:
+        data = request_fields(request, ('image',))
+        if not data or not data.get('image'):
+            return jsonify({'error': 'Missing required data'}), 400
+
+        with STAGE_SECONDS.time(stage='decode'):
+            image, scale = decode_gray_for_faces(image_bytes(data['image']), CLASSROOM_MIN_FACE_RATIO,
+                                                 CLASSROOM_DETECTION_WIDTH)
+        if image is None:
+            REJECTIONS.inc(reason='decode_failed')
+            return jsonify({'error': 'Failed to decode image'}), 400
+
+        with STAGE_SECONDS.time(stage='detect_classroom'):
+            boxes = detect_classroom_faces(image)
+        if len(boxes) == 0:
+            REJECTIONS.inc(reason='no_face')
             return jsonify({'error': 'No face detected'}), 400
 
-        # Find label for student_id
-        label = None
-        for k, v in label_map.items():
-            if v == data['student_id']:
-                label = k
-                break
-        if label is None:
-            return jsonify({'error': 'No registered face for this student'}), 404
-
-        pred_label, confidence = recognizer.predict(face)
-        threshold = 60  # Lower is stricter
-        if pred_label == label and confidence < threshold:
-            return jsonify({'success': True, 'verified': True, 'confidence': float(confidence)})
-        else:
-            return jsonify({'success': True, 'verified': False, 'confidence': float(confidence)})
+        with STAGE_SECONDS.time(stage='identify'):
+            recognized, unknown = face_model.identify_faces(image, boxes, VERIFY_THRESHOLD)
+        for match in recognized:
+            match['box'] = [int(round(v * scale)) for v in match['box']]
+            match['marked'] = mark_attendance(match['student_id'])
+
+        return jsonify({
+            'success': True,
+            'faces_detected': len(boxes),
+            'unknown_faces': unknown,
+            'recognized': recognized
+        })
+    except FaceInputError as e:
+        REJECTIONS.inc(reason='invalid_input')
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        logger.error(f"Error in verify_face: {str(e)}")
+        logger.error(f"Error in recognize_classroom: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/register', methods=['POST'])
 def register_face():
-    data = request.json
+    data = request_fields(request, ('image', 'face_image')) or {}
     student_id = data.get('student_id')
     img_b64 = data.get('image')
-    if not student_id or not img_b64:
+    face_image = data.get('face_image')
+    if not student_id or not (img_b64 or face_image):
         return jsonify({'success': False, 'message': 'Missing student_id or image'}), 400
     try:
-        img_bytes = base64.b64decode(img_b64)
-        img = Image.open(io.BytesIO(img_bytes)).convert('L')
-        img_np = np.array(img)
-        face = detect_and_crop_face(img_np)
+        face, frame_ratio = request_face(img_b64, data.get('face_box'), face_image)
         if face is None:
+            REJECTIONS.inc(reason='no_face')
             return jsonify({'success': False, 'message': 'No face detected'}), 400
-        save_path = os.path.join(KNOWN_FACES_FOLDER, f'{student_id}.jpg')
-        cv2.imwrite(save_path, face)
-        global label_map
-        label_map = train_recognizer()
+        reason = check_face(face, frame_ratio)
+        if reason:
+            return jsonify({'success': False, 'message': quality_error(reason)['error'], 'code': reason}), 400
+        # Overwriting an existing registration triggers a rebuild, new students are added incrementally
+        with STAGE_SECONDS.time(stage='enroll'):
+            face_model.add_face(f'{student_id}.jpg', face)
         return jsonify({'success': True, 'message': 'Face registered'})
+    except FaceInputError as e:
+        REJECTIONS.inc(reason='invalid_input')
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+def attendance_filters(args):
+    """Read the /attendance filter query parameters, raising ValueError on bad input"""
+    filters = {
+        'user_id': args.get('user_id') or None,
+        'date_from': args.get('from') or args.get('date') or None,
+        'date_to': args.get('to') or args.get('date') or None,
+        'status': args.get('status') or None,
+    }
+    for key in ('date_from', 'date_to'):
+        if filters[key] is not None:
+            datetime.datetime.strptime(filters[key], '%Y-%m-%d')
+    return filters
+
+def stream_attendance(rows, fmt):
+    """Render attendance rows one at a time as NDJSON or CSV"""
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['user_id', 'date', 'time', 'status'])
+        for row in rows:
+            writer.writerow([row['user_id'], row['date'], row['time'], row['status']])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for row in rows:
+            yield json.dumps(row) + '\n'
+
 @app.route('/attendance', methods=['GET'])
 def get_attendance():
-    """Endpoint to retrieve attendance records"""
+    """Endpoint to retrieve attendance records.
+
+    Query parameters: user_id, date (one day) or from/to (inclusive range), status,
+    limit and cursor for paging, and format=ndjson|csv for a streamed export.
+    Exports always hold every matching row, so they cannot be combined with paging.
+    """
     try:
-        if not os.path.exists(ATTENDANCE_FILE):
-            return jsonify({'success': True, 'attendance': []})
-        
-        attendance = []
-        with open(ATTENDANCE_FILE, 'r') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(row) >= 4:
-                    attendance.append({
-                        'user_id': row[0],
-                        'date': row[1],
-                        'time': row[2],
-                        'status': row[3]
-                    })
-        
+        try:
+            filters = attendance_filters(request.args)
+            limit = min(int(request.args.get('limit', ATTENDANCE_PAGE_SIZE)), ATTENDANCE_MAX_PAGE_SIZE)
+            cursor = int(request.args.get('cursor', 0))
+            if limit < 1 or cursor < 0:
+                raise ValueError('limit and cursor must be positive')
+        except ValueError as e:
+            return jsonify({'success': False, 'error': f'Invalid query parameters: {str(e)}'}), 400
+
+        fmt = request.args.get('format', 'json')
+        if fmt in ('ndjson', 'csv') and ('limit' in request.args or 'cursor' in request.args):
+            return jsonify({'success': False,
+                            'error': f'limit and cursor cannot be used with format={fmt}, exports are not paged'}), 400
+
+        # Make marks still sitting in the write queue visible
+        attendance_writer.flush()
+        if fmt in ('ndjson', 'csv'):
+            mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+            rows = attendance_store.iter_rows(**filters)
+            return Response(stream_with_context(stream_attendance(rows, fmt)), mimetype=mimetype)
+
+        attendance, next_cursor = attendance_store.query(cursor=cursor, limit=limit, **filters)
         return jsonify({
             'success': True,
-            'attendance': attendance
+            'attendance': attendance,
+            'next_cursor': next_cursor
         })
         
     except Exception as e:
@@ -259,5 +428,11 @@ def health_check():
         'timestamp': datetime.datetime.now().isoformat()
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Request, stage latency and rejection metrics in the Prometheus text format"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # The reloader and debugger are for development only; set FLASK_DEBUG=1 to get them back
+    app.run(host='0.0.0.0', port=5000, debug=os.environ.get('FLASK_DEBUG') == '1', threaded=True)
\ No newline at end of file
@@ -1,92 +1,101 @@
+import argparse
+import atexit
 import cv2
-import numpy as np
 import os
-import csv
-from datetime import datetime
+from face_detection import detect_faces
+from face_model import FaceModel, stem_from_filename
+from face_tracker import FaceTracker
+from attendance_store import AttendanceStore, AttendanceWriter
+from video_pipeline import RecognitionPipeline, draw_stats
 
 KNOWN_FACES_DIR = 'known_faces'  # Each image: person_name.jpg
 ATTENDANCE_FILE = 'attendance.csv'
+MODEL_DIR = 'trained_model'
 FACE_SIZE = (200, 200)
 THRESHOLD = 60  # Lower = stricter, 60 is a good start
 
 # Ensure directories exist
 os.makedirs(KNOWN_FACES_DIR, exist_ok=True)
 
-# Initialize face detector and recognizer
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-recognizer = cv2.face.LBPHFaceRecognizer_create()
+# Initialize recognizer, detection goes through face_detection.detect_faces
+face_model = FaceModel(KNOWN_FACES_DIR, label_for_file=stem_from_filename, face_size=FACE_SIZE,
+                       model_dir=MODEL_DIR)
 
 # Load faces and labels
 def load_faces_and_labels():
-    faces = []
-    labels = []
-    label_map = {}
-    for idx, filename in enumerate(os.listdir(KNOWN_FACES_DIR)):
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-            path = os.path.join(KNOWN_FACES_DIR, filename)
-            img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
-            if img is None:
-                continue
-            faces.append(cv2.resize(img, FACE_SIZE))
-            labels.append(idx)
-            label_map[idx] = os.path.splitext(filename)[0]
+    faces, labels, label_map, _ = face_model.load_faces_and_labels()
     return faces, labels, label_map
 
 # Train recognizer
 def train_recognizer():
-    faces, labels, label_map = load_faces_and_labels()
-    if len(faces) > 0:
-        recognizer.train(faces, np.array(labels))
-    return label_map
+    return face_model.train()
 
-label_map = train_recognizer()
+# Reuse the saved model unless known_faces changed; predictions go through face_model so they follow retrains
+face_model.load_or_train()
 
 # Attendance logging
+attendance_store = AttendanceStore(ATTENDANCE_FILE)
+# Rows are written in batches off the recognition threads and flushed on exit
+attendance_writer = AttendanceWriter(attendance_store)
+atexit.register(attendance_writer.close)
+
 def mark_attendance(name):
-    now = datetime.now()
-    date_str = now.strftime('%Y-%m-%d')
-    time_str = now.strftime('%H:%M:%S')
     # Prevent duplicate attendance for the same day
-    if os.path.exists(ATTENDANCE_FILE):
-        with open(ATTENDANCE_FILE, 'r') as f:
-            for line in f:
-                if name in line and date_str in line:
-                    return False
-    with open(ATTENDANCE_FILE, 'a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow([name, date_str, time_str, 'Present'])
-    return True
+    return attendance_writer.mark(name, 'Present')
+
+# Faces are tracked between frames and only re-recognized now and then
+tracker = FaceTracker()
+
+# Detection and recognition, runs on the pipeline's worker threads
+def recognize_frame(frame, seq):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    visible, to_recognize = tracker.update(detect_faces(gray, 1.2, 5), seq)
+    for track in to_recognize:
+        x, y, w, h = track.box
+        face_resized = cv2.resize(gray[y:y+h, x:x+w], FACE_SIZE)
+        try:
+            pred_label, name, confidence = face_model.predict(face_resized)
+        except cv2.error:
+            name, confidence = None, None
+        if confidence is None or confidence >= THRESHOLD:
+            name = None
+        # Attendance is only marked once several predictions for the track agree
+        accepted = tracker.vote(track, name, confidence)
+        if accepted:
+            mark_attendance(accepted)
+    return [(track.box, track.id, track.identity, track.confidence) for track in visible]
+
+def draw_results(frame, results, stats):
+    for (x, y, w, h), track_id, name, confidence in results:
+        color = (0, 255, 0) if name else (0, 0, 255)
+        label_text = f"#{track_id} {name} ({confidence:.1f})" if name else f"#{track_id} Unknown"
+        cv2.rectangle(frame, (x, y), (x+w, y+h), color, 2)
+        cv2.putText(frame, label_text, (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
+    draw_stats(frame, stats)
+    cv2.imshow('LBPH Face Recognition', frame)
+    return not (cv2.waitKey(1) & 0xFF == ord('q'))
 
 # Main recognition loop
 def main():
-    cap = cv2.VideoCapture(0)
-    print('Press Q to quit.')
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.2, 5)
-        for (x, y, w, h) in faces:
-            face_img = gray[y:y+h, x:x+w]
-            face_resized = cv2.resize(face_img, FACE_SIZE)
-            try:
-                pred_label, confidence = recognizer.predict(face_resized)
-                name = label_map.get(pred_label, 'Unknown')
-                color = (0, 255, 0) if confidence < THRESHOLD else (0, 0, 255)
-                label_text = f"{name} ({confidence:.1f})" if confidence < THRESHOLD else "Unknown"
-                if confidence < THRESHOLD:
-                    mark_attendance(name)
-            except:
-                color = (0, 0, 255)
-                label_text = "Unknown"
-            cv2.rectangle(frame, (x, y), (x+w, y+h), color, 2)
-            cv2.putText(frame, label_text, (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
-        cv2.imshow('LBPH Face Recognition', frame)
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-    cap.release()
-    cv2.destroyAllWindows()
+    parser = argparse.ArgumentParser(description='Live LBPH face recognition and attendance')
+    parser.add_argument('--source', default='0', help='camera index, video file or image directory')
+    parser.add_argument('--workers', type=int, default=2, help='recognition threads')
+    parser.add_argument('--every', type=int, default=1, help='process every Nth frame')
+    parser.add_argument('--headless', action='store_true', help='no window, print stats at the end')
+    args = parser.parse_args()
+
+    pipeline = RecognitionPipeline(args.source, recognize_frame,
+                                   render=None if args.headless else draw_results,
+                                   workers=args.workers, process_every=args.every)
+    if not args.headless:
+        print('Press Q to quit.')
+    try:
+        stats = pipeline.run()
+    finally:
+        if not args.headless:
+            cv2.destroyAllWindows()
+    print(stats.summary())
+    print(tracker.summary())
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
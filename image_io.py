@@ -0,0 +1,167 @@
+import base64
+import io
+import json
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from face_detection import DETECTION_WIDTH, FACE_SIZE, MIN_FACE_RATIO, FaceInputError
+
+OCTET_STREAM = 'application/octet-stream'
+MULTIPART = 'multipart/form-data'
+# A data URL header ("data:image/jpeg;base64,") is short and base64 has no commas
+DATA_URL_HEADER_MAX = 100
+
+# JPEGs are decoded at 1/2, 1/4 or 1/8 scale (libjpeg DCT scaling) when the
+# smallest face we look for still comes out at least this many pixels wide,
+# so the 200x200 crop is never upsampled from less detail than it needs
+REDUCED_DECODE = os.environ.get('FACE_REDUCED_DECODE', '1') != '0'
+MIN_DECODED_FACE = int(os.environ.get('FACE_MIN_DECODED_FACE', FACE_SIZE[0]))
+REDUCED_GRAYSCALE = {
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+}
+JPEG_MAGIC = b'\xff\xd8'
+# cv2.imdecode applies the EXIF orientation; orientations 5-8 turn the image by
+# 90 degrees, so its width is the height stored in the header
+EXIF_ORIENTATION = 0x0112
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def image_bytes(value):
+    """Raw bytes of an image field.
+
+    Binary uploads are passed through untouched; strings are base64, optionally
+    with a data URL prefix. Returns None for a missing field and raises
+    FaceInputError for anything else, such as a number or a list in a JSON body.
+    """
+    if value is None or isinstance(value, (bytes, bytearray, memoryview)):
+        return value
+    if not isinstance(value, str):
+        raise FaceInputError('Image must be a base64 string or an uploaded file')
+    comma = value.find(',', 0, DATA_URL_HEADER_MAX)
+    if comma != -1:
+        value = value[comma + 1:]
+    try:
+        return base64.b64decode(value)
+    except ValueError:
+        raise FaceInputError('Image is not valid base64')
+
+
+def decode_gray_image(data):
+    """Decode image bytes into a grayscale frame without copying the buffer, None if not an image"""
+    if data is None or len(data) == 0:
+        return None
+    frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if frame is None:
+        return None
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+
+def image_size(data):
+    """(width, height) after EXIF orientation, from the header without decoding pixels, None if unreadable"""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            width, height = img.size
+            if img.getexif().get(EXIF_ORIENTATION) in TRANSPOSED_ORIENTATIONS:
+                return height, width
+            return width, height
+    except Exception:
+        return None
+
+
+def decode_scale(width, min_face_ratio=MIN_FACE_RATIO, working_width=DETECTION_WIDTH):
+    """Largest JPEG reduction that keeps detection input and the smallest face intact.
+
+    Detection never looks at more than working_width pixels, and the smallest
+    face it accepts is min_face_ratio of the frame width; both must survive.
+    """
+    for scale in REDUCED_GRAYSCALE:
+        if width / scale >= working_width and width * min_face_ratio / scale >= MIN_DECODED_FACE:
+            return scale
+    return 1
+
+
+def decode_gray_for_faces(data, min_face_ratio=MIN_FACE_RATIO, working_width=DETECTION_WIDTH):
+    """Decode an uploaded frame to grayscale at the smallest useful resolution.
+
+    Returns (gray, scale): coordinates in gray times scale are full-resolution
+    coordinates. Only JPEGs are reduced, since other formats would be decoded in
+    full and resized anyway. gray is None if the data is not an image.
+    """
+    if data is None or len(data) == 0:
+        return None, 1
+    scale = 1
+    if REDUCED_DECODE and bytes(data[:2]) == JPEG_MAGIC:
+        size = image_size(data)
+        if size:
+            scale = decode_scale(size[0], min_face_ratio, working_width)
+    if scale == 1:
+        return decode_gray_image(data), 1
+    return cv2.imdecode(np.frombuffer(data, np.uint8), REDUCED_GRAYSCALE[scale]), scale
+
+
+def scale_box(box, scale):
+    """Map a full-resolution [x, y, w, h] face_box into a frame decoded at 1/scale"""
+    if box is None or scale == 1 or not isinstance(box, (list, tuple)) or len(box) != 4:
+        return box
+    try:
+        return [float(v) / scale for v in box]
+    except (TypeError, ValueError):
+        return box
+
+
+def parse_box_field(value):
+    """face_box from a form or query field: "x,y,w,h" or a JSON list; other types pass through"""
+    if not isinstance(value, str):
+        return value
+    value = value.strip()
+    if not value:
+        return None
+    if value.startswith('['):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    return value.split(',')
+
+
+def parse_flag(value, default=True):
+    """Boolean from JSON or a form/query string"""
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return value.strip().lower() not in ('0', 'false', 'no', 'off', '')
+    return bool(value)
+
+
+def request_fields(request, image_fields):
+    """Read a Flask request as a dict in the same shape as the JSON API.
+
+    - application/json: the parsed body, images as base64 strings
+    - multipart/form-data: form fields, plus each uploaded image file as bytes
+    - application/octet-stream: the body is the first of image_fields, the other
+      fields come from the query string
+
+    Returns None for an unreadable body.
+    """
+    if request.mimetype == OCTET_STREAM:
+        fields = request.args.to_dict()
+        fields[image_fields[0]] = request.get_data(cache=False)
+    elif request.mimetype == MULTIPART:
+        fields = request.form.to_dict()
+        for name in image_fields:
+            upload = request.files.get(name)
+            if upload is not None:
+                fields[name] = upload.read()
+    else:
+        fields = request.get_json(silent=True)
+        if not isinstance(fields, dict):
+            return None
+        return fields
+    if 'face_box' in fields:
+        fields['face_box'] = parse_box_field(fields['face_box'])
+    return fields
@@ -0,0 +1,240 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from a cached histogram predict (~1 ms) up to a full retrain
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# LBPH chi-square distances; the verification threshold is 60
+CONFIDENCE_BUCKETS = (10, 20, 30, 40, 50, 60, 70, 80, 100, 150)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.samples = {}  # label values -> value
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def collect(self):
+        with self.lock:
+            return dict(self.samples)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that is set, or read from `function` at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.samples[key] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def collect(self):
+        if self.function is None:
+            return super().collect()
+        try:
+            return {(): self.function()}
+        except Exception:
+            return {}
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            sample = self.samples.get(key)
+            if sample is None:
+                # Per-bucket (not cumulative) counts, the last one for +Inf, then sum and count
+                sample = self.samples[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            sample[0][i] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        with self.lock:
+            return {key: [list(counts), total, n] for key, (counts, total, n) in self.samples.items()}
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Updates take one small per-metric lock, so instrumenting a request stage costs
+    a couple of microseconds. `snapshot()` returns plain data that can cross a
+    process boundary, and `render()` merges snapshots from other processes (e.g.
+    the ASGI front end's workers) into one exposition.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def snapshot(self):
+        """Current values of every metric as picklable data"""
+        return {
+            metric.name: {
+                'kind': metric.kind,
+                'help': metric.help,
+                'labels': metric.label_names,
+                'buckets': getattr(metric, 'buckets', None),
+                'samples': metric.collect(),
+            }
+            for metric in list(self.metrics.values())
+        }
+
+    def render(self, *others):
+        """Prometheus text exposition of this registry plus snapshots from other processes"""
+        return render(merge([self.snapshot(), *others]))
+
+
+def merge(snapshots):
+    """Add up counters and histograms across snapshots; gauges keep the last value seen"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for key, value in metric['samples'].items():
+                if metric['kind'] == 'gauge' or key not in target['samples']:
+                    target['samples'][key] = [list(value[0]), value[1], value[2]] \
+                        if metric['kind'] == 'histogram' else value
+                elif metric['kind'] == 'counter':
+                    target['samples'][key] += value
+                else:
+                    counts, total, n = target['samples'][key]
+                    target['samples'][key] = [[a + b for a, b in zip(counts, value[0])], total + value[1],
+                                              n + value[2]]
+    return merged
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def render(snapshot):
+    lines = []
+    for name, metric in sorted(snapshot.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for key, value in sorted(metric['samples'].items()):
+            if metric['kind'] != 'histogram':
+                lines.append(f"{name}{_labels(metric['labels'], key)} {_number(value)}")
+                continue
+            counts, total, n = value
+            cumulative = 0
+            for bound, count in zip(list(metric['buckets']) + ['+Inf'], counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{_labels(metric['labels'], key, le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric['labels'], key)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(metric['labels'], key)} {n}")
+    return '\n'.join(lines) + '\n'
+
+
+# Shared by both services (each runs in its own process) and the scripts
+REGISTRY = MetricsRegistry()
+REQUESTS = REGISTRY.counter('face_requests_total', 'HTTP requests by route and status code',
+                            ('endpoint', 'status'))
+REQUEST_SECONDS = REGISTRY.histogram('face_request_seconds', 'HTTP request latency by route', ('endpoint',))
+STAGE_SECONDS = REGISTRY.histogram('face_stage_seconds', 'Time spent in each recognition stage', ('stage',))
+REJECTIONS = REGISTRY.counter('face_rejections_total', 'Requests rejected before a verdict, by reason',
+                              ('reason',))
+CONFIDENCE = REGISTRY.histogram('face_confidence', 'LBPH distance of verification predictions (lower is closer)',
+                                buckets=CONFIDENCE_BUCKETS)
+TRAIN_SECONDS = REGISTRY.histogram('face_train_seconds', 'Duration of recognizer training and gallery updates',
+                                   ('kind',))
+GALLERY_SIZE = REGISTRY.gauge('face_gallery_size', 'Enrolled face samples')
+SHARD_LOOKUPS = REGISTRY.counter('face_shard_lookups_total',
+                                 'Class group gallery shard lookups: hit, reused after a store change, or built',
+                                 ('result',))
+QUALITY_THRESHOLDS = REGISTRY.gauge('face_quality_threshold', 'Quality gate thresholds in effect (1/0 for flags)',
+                                    ('check',))
+
+
+def instrument_flask(app):
+    """Count and time every request of a Flask app by route and status"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_request_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop('metrics_start', None)
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+        if start is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+        return response
+
+    return app
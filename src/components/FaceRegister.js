@@ -1,6 +1,7 @@
 import React, { useRef, useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import axios from 'axios';
+import { detectFaceBox } from '../utils/faceBox';
 
 const FaceRegister = () => {
   const videoRef = useRef(null);
@@ -51,6 +52,7 @@ const FaceRegister = () => {
     const ctx = canvas.getContext('2d');
     ctx.drawImage(video, 0, 0, canvas.width, canvas.height);
     const imageData = canvas.toDataURL('image/jpeg');
+    const faceBox = await detectFaceBox(canvas);
 
     try {
       const studentId = localStorage.getItem('studentId') || prompt('Enter your Student ID:');
@@ -65,7 +67,8 @@ const FaceRegister = () => {
       // Send to Node.js backend which will handle both Python and database operations
       const response = await axios.post('http://localhost:3001/register-face', {
         student_id: studentId,
-        image: imageData
+        image: imageData,
+        ...(faceBox && { face_box: faceBox })
       }).catch(error => {
         console.error('Server error:', error);
         if (error.code === 'ERR_CONNECTION_REFUSED') {
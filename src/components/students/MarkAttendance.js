@@ -1,6 +1,7 @@
 import React, { useState, useRef, useEffect } from 'react';
 import Webcam from 'react-webcam';
 import axios from 'axios';
+import { detectFaceBox } from '../../utils/faceBox';
 import { useLocation } from 'react-router-dom';
 import './MarkAttendance.css';
 
@@ -128,6 +129,9 @@ const MarkAttendance = () => {
       ctx.scale(-1, 1);
       ctx.drawImage(img, 0, 0);
       
+      // Locate the face on the flipped frame so the server can skip detection
+      const faceBox = await detectFaceBox(canvas);
+
       // Get the flipped image as base64
       const flippedImage = canvas.toDataURL('image/jpeg', 0.7)
         .replace('image/jpeg', 'image/jpeg;quality=0.7')
@@ -142,6 +146,7 @@ const MarkAttendance = () => {
       const response = await axios.post('http://localhost:3001/verify-attendance', {
         student_id: selectedStudent,
         image: flippedImage,
+        ...(faceBox && { face_box: faceBox }),
         date: attendanceDate,
         class_details: {
           subject: classDetails.subject,
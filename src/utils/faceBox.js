@@ -0,0 +1,20 @@
+// Locate the face in a captured frame so the recognition service can skip its
+// full-frame Haar cascade. Uses the browser Shape Detection API where available
+// and returns null otherwise, in which case the server detects the face itself.
+export const detectFaceBox = async (source) => {
+  if (typeof window === 'undefined' || !('FaceDetector' in window)) {
+    return null;
+  }
+  try {
+    const detector = new window.FaceDetector({ maxDetectedFaces: 2, fastMode: true });
+    const faces = await detector.detect(source);
+    if (faces.length !== 1) {
+      return null;
+    }
+    const { x, y, width, height } = faces[0].boundingBox;
+    return [Math.round(x), Math.round(y), Math.round(width), Math.round(height)];
+  } catch (err) {
+    console.warn('Face detection in the browser failed:', err);
+    return null;
+  }
+};
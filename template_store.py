@@ -0,0 +1,270 @@
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from face_gallery import FaceGallery, extract_histograms
+from face_model import FACE_SIZE, _write_json_atomic, file_entry, image_files, load_faces, student_id_from_filename
+from metrics import TRAIN_SECONDS
+
+try:
+    import fcntl
+except ImportError:  # Windows: only one process writes, threads are still serialized
+    fcntl = None
+
+# Bump when the on-disk layout changes so old stores are rebuilt
+STORE_FORMAT_VERSION = 1
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'store.lock'
+# Faces decoded and extracted per LBPH call (and per pool task) while rebuilding
+EXTRACT_CHUNK = 64
+# Times gallery() re-reads the index when the data file it names was replaced before it could be mapped
+MAP_ATTEMPTS = 5
+
+
+class TemplateStore:
+    """Gallery histograms in a memory-mapped file shared by every worker process.
+
+    The store directory holds a raw float32 matrix (`templates-<generation>.f32`,
+    one LBPH histogram per row) and `index.json`, which names the data file and
+    lists the row count, the identity and file of every row, and the gallery
+    manifest. Readers map the matrix read-only, so N workers share one copy in the
+    page cache instead of each holding a trained recognizer.
+
+    Writers take an exclusive file lock. A new enrollment appends its row to the
+    data file, fsyncs it and then atomically replaces the index with a bumped
+    generation; rows past the indexed count are never read, so readers mapping
+    the old generation are unaffected. Removing or replacing a file writes a new
+    data file instead. Each reader stats the index per call and remaps when it
+    changed, so workers pick up enrollments without retraining.
+    """
+
+    def __init__(self, store_dir, faces_dir, label_for_file=student_id_from_filename, face_size=FACE_SIZE):
+        self.store_dir = store_dir
+        self.faces_dir = faces_dir
+        self.label_for_file = label_for_file
+        self.face_size = tuple(face_size)
+        self.index_path = os.path.join(store_dir, INDEX_FILE)
+        self.lock = threading.Lock()
+        self._mapped = None  # (index stat key, FaceGallery)
+
+    @contextmanager
+    def _write_lock(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        with self.lock, open(os.path.join(self.store_dir, LOCK_FILE), 'a') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _header(self):
+        return {
+            'version': STORE_FORMAT_VERSION,
+            'opencv': cv2.__version__,
+            'face_size': list(self.face_size),
+            'label_scheme': self.label_for_file.__name__,
+        }
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if any(index.get(k) != v for k, v in self._header().items()):
+            return None
+        return index
+
+    def _map(self, index):
+        """Map the indexed rows of the data file read-only"""
+        if index['rows'] == 0:
+            return np.empty((0, index['dim']), dtype=np.float32)
+        return np.memmap(os.path.join(self.store_dir, index['data_file']), dtype=np.float32, mode='r',
+                         shape=(index['rows'], index['dim']))
+
+    def _index_key(self):
+        try:
+            stat = os.stat(self.index_path)
+            return stat.st_ino, stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def gallery(self):
+        """The FaceGallery of the current generation, remapped only when the index changed"""
+        key = self._index_key()
+        mapped = self._mapped
+        if mapped and mapped[0] == key:
+            return mapped[1]
+        for _ in range(MAP_ATTEMPTS):
+            index = self._read_index() if key else None
+            if index is None:
+                self.sync()
+                key = self._index_key()
+                index = self._read_index() if key else None
+                if index is None:
+                    raise RuntimeError(f"Template store {self.store_dir} has no valid index after a sync")
+            try:
+                histograms = self._map(index)
+            except FileNotFoundError:
+                # A writer published a new data file and removed this one after we read the index
+                key = self._index_key()
+                continue
+            break
+        else:
+            raise RuntimeError(f"Template store {self.store_dir} kept changing while it was being mapped")
+        identities = index['identities']
+        entries = index['entries']
+        sources = [(f, entries.get(f, {}).get('sha1')) for f in index['files']]
+        gallery = FaceGallery(histograms, np.arange(len(identities)), dict(enumerate(identities)),
+                              index['generation'], sources)
+        self._mapped = (key, gallery)
+        return gallery
+
+    def _image_files(self):
+        return image_files(self.faces_dir)
+
+    def _extract(self, filenames):
+        """Histograms for the readable files among filenames, as (matrix, kept filenames).
+
+        Each pool task decodes a chunk and extracts its histograms, so both run in parallel.
+        """
+        chunks, _ = load_faces(self.faces_dir, filenames, self.face_size, transform=extract_histograms,
+                               chunk_size=EXTRACT_CHUNK)
+        kept = [filename for names, _ in chunks for filename in names]
+        blocks = [matrix for names, matrix in chunks if names]
+        if not blocks:
+            return None, kept
+        return np.vstack(blocks), kept
+
+    def _publish(self, index):
+        index['generation'] = index.get('generation', 0) + 1
+        _write_json_atomic(self.index_path, index)
+
+    def _append(self, index, matrix, filenames):
+        """Append rows to the current data file and publish them (caller holds the write lock)"""
+        if index['rows'] == 0 or index['dim'] != matrix.shape[1]:
+            return self._rewrite(index, matrix, filenames, [])
+        path = os.path.join(self.store_dir, index['data_file'])
+        # Drop a partial append left by a crashed writer before adding rows
+        os.truncate(path, index['rows'] * index['dim'] * 4)
+        with open(path, 'ab') as f:
+            f.write(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        index['rows'] += len(filenames)
+        index['files'] += filenames
+        index['identities'] += [self.label_for_file(f) for f in filenames]
+        self._publish(index)
+
+    def _rewrite(self, index, matrix, filenames, keep_rows):
+        """Write a new data file from kept rows of the old one plus new rows (caller holds the write lock)"""
+        old = self._map(index) if index.get('data_file') and index['rows'] else None
+        blocks = []
+        files = []
+        if keep_rows:
+            blocks.append(np.asarray(old[keep_rows]))
+            files += [index['files'][i] for i in keep_rows]
+        if matrix is not None:
+            blocks.append(matrix)
+            files += filenames
+        generation = index.get('generation', 0) + 1
+        data_file = f"templates-{generation}.f32"
+        tmp_path = os.path.join(self.store_dir, f"tmp_{data_file}")
+        combined = np.vstack(blocks).astype(np.float32, copy=False) if blocks else None
+        with open(tmp_path, 'wb') as f:
+            if combined is not None:
+                f.write(np.ascontiguousarray(combined).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.store_dir, data_file))
+        previous = index.get('data_file')
+        index.update({
+            'data_file': data_file,
+            'rows': len(files),
+            'dim': combined.shape[1] if combined is not None else 0,
+            'files': files,
+            'identities': [self.label_for_file(f) for f in files],
+        })
+        self._publish(index)
+        if previous and previous != data_file:
+            try:
+                # Readers that still map it keep their pages until they remap; a reader that read the
+                # old index but has not mapped it yet gets FileNotFoundError and retries in gallery()
+                os.remove(os.path.join(self.store_dir, previous))
+            except OSError:
+                pass
+
+    def sync(self, rebuild=False, filenames=None):
+        """Bring the store in line with the faces directory, return the number of templates.
+
+        New files are appended; changed or deleted files trigger a rewrite that
+        copies the unchanged rows and only extracts histograms for changed files.
+        filenames limits the check to those files instead of scanning the directory.
+        """
+        with self._write_lock():
+            index = None if rebuild else self._read_index()
+            if index is None:
+                # A new store is always built from the whole directory
+                filenames = None
+                index = dict(self._header(), generation=(self._read_index() or {}).get('generation', 0),
+                             data_file=None, rows=0, dim=0, files=[], identities=[], entries={})
+            saved = index['entries']
+            if filenames is None:
+                current = {f: file_entry(os.path.join(self.faces_dir, f), saved.get(f))
+                           for f in self._image_files()}
+            else:
+                current = {f: e for f, e in saved.items() if f not in filenames}
+                for f in filenames:
+                    if os.path.isfile(os.path.join(self.faces_dir, f)):
+                        current[f] = file_entry(os.path.join(self.faces_dir, f), saved.get(f))
+            unchanged = {f for f, e in current.items() if f in saved and saved[f]['sha1'] == e['sha1']}
+            added = sorted(f for f in current if f not in unchanged)
+            stale = set(saved) - unchanged
+            index['entries'] = current
+            if not added and not stale and index['data_file']:
+                if current != saved:
+                    # Only mtimes moved; keep the hashes fresh without a new generation
+                    _write_json_atomic(self.index_path, index)
+                return index['rows']
+
+            rewrite = bool(stale or not index['data_file'])
+            with TRAIN_SECONDS.time(kind='full' if rewrite else 'incremental'):
+                matrix, kept = self._extract(added)
+                if rewrite:
+                    keep_rows = [i for i, f in enumerate(index['files']) if f in unchanged]
+                    self._rewrite(index, matrix, kept, keep_rows)
+                    print(f"Template store rebuilt with {index['rows']} faces")
+                elif kept:
+                    self._append(index, matrix, kept)
+                    print(f"Added {len(kept)} faces to the template store")
+                else:
+                    _write_json_atomic(self.index_path, index)
+            return index['rows']
+
+    def add_face(self, filename, face):
+        """Save a face sample and publish its histogram without touching the other rows"""
+        face = cv2.resize(face, self.face_size)
+        with self._write_lock():
+            index = self._read_index()
+            replace = index is None or filename in index['entries']
+            if not replace:
+                with TRAIN_SECONDS.time(kind='incremental'):
+                    cv2.imwrite(os.path.join(self.faces_dir, filename), face)
+                    index['entries'][filename] = file_entry(os.path.join(self.faces_dir, filename))
+                    self._append(index, extract_histograms([face]), [filename])
+                return index['rows']
+        cv2.imwrite(os.path.join(self.faces_dir, filename), face)
+        return self.sync()
+
+    def remove_face(self, filename):
+        """Delete a face sample and publish a store without it"""
+        path = os.path.join(self.faces_dir, filename)
+        if os.path.exists(path):
+            os.remove(path)
+        return self.sync()
@@ -1,19 +1,21 @@
 import cv2
-import numpy as np
 import os
 from datetime import datetime
+from face_detection import detect_faces
+from face_model import FaceModel
+from video_pipeline import RecognitionPipeline, draw_stats
 
 # Constants
 KNOWN_FACES_DIR = 'known_faces'
+MODEL_DIR = 'trained_model'
 FACE_SIZE = (200, 200)
 THRESHOLD = 60
 
 # Ensure directories exist
 os.makedirs(KNOWN_FACES_DIR, exist_ok=True)
 
-# Initialize face detector and recognizer
-face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-recognizer = cv2.face.LBPHFaceRecognizer_create()
+# Initialize recognizer, detection goes through face_detection.detect_faces
+face_model = FaceModel(KNOWN_FACES_DIR, face_size=FACE_SIZE, model_dir=MODEL_DIR)
 
 def register_face(name):
     """Register a new face"""
@@ -26,7 +28,7 @@ def register_face(name):
             break
             
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.2, 5)
+        faces = detect_faces(gray, 1.2, 5)
         
         for (x, y, w, h) in faces:
             cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
@@ -42,7 +44,7 @@ def register_face(name):
                 face_img = gray[y:y+h, x:x+w]
                 face_resized = cv2.resize(face_img, FACE_SIZE)
                 filename = f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-                cv2.imwrite(os.path.join(KNOWN_FACES_DIR, filename), face_resized)
+                face_model.add_face(filename, face_resized)
                 print(f"Face registered successfully as {filename}")
                 break
             else:
@@ -50,69 +52,55 @@ def register_face(name):
     
     cap.release()
     cv2.destroyAllWindows()
-    train_recognizer()
 
 def train_recognizer():
     """Train the face recognizer with all registered faces"""
-    faces = []
-    labels = []
-    label_map = {}
-    
-    for idx, filename in enumerate(os.listdir(KNOWN_FACES_DIR)):
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-            path = os.path.join(KNOWN_FACES_DIR, filename)
-            img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
-            if img is None:
-                continue
-            faces.append(cv2.resize(img, FACE_SIZE))
-            labels.append(idx)
-            label_map[idx] = os.path.splitext(filename)[0].split('_')[0]
-    
-    if len(faces) > 0:
-        recognizer.train(faces, np.array(labels))
-        print(f"Recognizer trained with {len(faces)} faces")
-    return label_map
+    return face_model.train()
+
+def recognize_frame(frame, seq=None):
+    """Detect and identify the faces in one frame, runs on the pipeline workers; frames are independent"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    results = []
+    for (x, y, w, h) in detect_faces(gray, 1.2, 5):
+        face_resized = cv2.resize(gray[y:y+h, x:x+w], FACE_SIZE)
+        try:
+            pred_label, name, confidence = face_model.predict(face_resized)
+        except cv2.error:
+            name, confidence = None, None
+        if confidence is None or confidence >= THRESHOLD:
+            name = None
+        results.append(((x, y, w, h), name, confidence))
+    return results
 
-def recognize_faces():
-    """Recognize faces in real-time"""
-    label_map = train_recognizer()
+def draw_results(frame, results, stats):
+    """Draw boxes and names, return False when Q is pressed"""
+    for (x, y, w, h), name, confidence in results:
+        color = (0, 255, 0) if name else (0, 0, 255)
+        label_text = f"{name} ({confidence:.1f})" if name else "Unknown"
+        cv2.rectangle(frame, (x, y), (x+w, y+h), color, 2)
+        cv2.putText(frame, label_text, (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
+    draw_stats(frame, stats)
+    cv2.imshow('Face Recognition', frame)
+    return not (cv2.waitKey(1) & 0xFF == ord('q'))
+
+def recognize_faces(source=0, headless=False):
+    """Recognize faces from a camera, video file or image directory"""
+    label_map = face_model.load_or_train()
     if not label_map:
         print("No faces registered. Please register faces first.")
         return
     
-    cap = cv2.VideoCapture(0)
-    print('Press Q to quit.')
-    
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-            
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.2, 5)
-        
-        for (x, y, w, h) in faces:
-            face_img = gray[y:y+h, x:x+w]
-            face_resized = cv2.resize(face_img, FACE_SIZE)
-            
-            try:
-                pred_label, confidence = recognizer.predict(face_resized)
-                name = label_map.get(pred_label, 'Unknown')
-                color = (0, 255, 0) if confidence < THRESHOLD else (0, 0, 255)
-                label_text = f"{name} ({confidence:.1f})" if confidence < THRESHOLD else "Unknown"
-            except:
-                color = (0, 0, 255)
-                label_text = "Unknown"
-                
-            cv2.rectangle(frame, (x, y), (x+w, y+h), color, 2)
-            cv2.putText(frame, label_text, (x, y-10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
-        
-        cv2.imshow('Face Recognition', frame)
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-    
-    cap.release()
-    cv2.destroyAllWindows()
+    pipeline = RecognitionPipeline(source, recognize_frame,
+                                   render=None if headless else draw_results)
+    if not headless:
+        print('Press Q to quit.')
+    try:
+        stats = pipeline.run()
+    finally:
+        if not headless:
+            cv2.destroyAllWindows()
+    print(stats.summary())
+    return stats
 
 if __name__ == '__main__':
     while True:
@@ -0,0 +1,238 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import cv2
+
+from face_model import IMAGE_EXTENSIONS
+
+# Latencies kept for the rolling p50/p95 shown on screen and in the summary
+LATENCY_WINDOW = 300
+
+
+class ImageDirectorySource:
+    """Reads the images of a directory in name order, with the cv2.VideoCapture read/release API"""
+
+    def __init__(self, path):
+        self.paths = [os.path.join(path, f) for f in sorted(os.listdir(path))
+                      if f.lower().endswith(IMAGE_EXTENSIONS)]
+        self.index = 0
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        while self.index < len(self.paths):
+            frame = cv2.imread(self.paths[self.index])
+            self.index += 1
+            if frame is not None:
+                return True, frame
+        return False, None
+
+    def release(self):
+        self.index = len(self.paths)
+
+
+def open_source(source):
+    """Open a camera index, video file or image directory.
+
+    Returns (capture, live). Only live sources (cameras) drop frames when the
+    workers fall behind; files and directories are processed frame by frame.
+    """
+    if isinstance(source, int) or str(source).isdigit():
+        return cv2.VideoCapture(int(source)), True
+    if os.path.isdir(source):
+        return ImageDirectorySource(source), False
+    return cv2.VideoCapture(source), False
+
+
+class LatestFrame:
+    """Single slot holding the newest captured frame; a new frame replaces an unclaimed one"""
+
+    def __init__(self):
+        self.item = None
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, item, block=False):
+        """Store an item, return True if it replaced one no worker had taken yet"""
+        with self.condition:
+            while block and self.item is not None and not self.closed:
+                self.condition.wait()
+            replaced = self.item is not None
+            self.item = item
+            self.condition.notify_all()
+            return replaced
+
+    def get(self):
+        """Wait for the next item, return None once closed and drained"""
+        with self.condition:
+            while self.item is None and not self.closed:
+                self.condition.wait()
+            item, self.item = self.item, None
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class PipelineStats:
+    """Frame counters and capture-to-result latency of a pipeline run"""
+
+    def __init__(self):
+        self.captured = 0
+        self.skipped = 0    # dropped by the frame skip policy
+        self.dropped = 0    # replaced before a worker picked them up
+        self.processed = 0
+        self.rendered = 0
+        self.stale = 0      # finished after a newer frame had been rendered
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, counter, n=1):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def record_latency(self, seconds):
+        with self.lock:
+            self.processed += 1
+            self.latencies.append(seconds * 1000)
+
+    def fps(self):
+        elapsed = time.perf_counter() - self.started
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def latency_percentile(self, pct):
+        with self.lock:
+            values = sorted(self.latencies)
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+    def summary(self):
+        return (f"captured={self.captured} processed={self.processed} rendered={self.rendered} "
+                f"skipped={self.skipped} dropped={self.dropped} stale={self.stale} errors={self.errors} "
+                f"fps={self.fps():.1f} latency p50={self.latency_percentile(50):.1f}ms "
+                f"p95={self.latency_percentile(95):.1f}ms")
+
+
+class RecognitionPipeline:
+    """Capture -> recognition workers -> render, each stage on its own thread(s).
+
+    The capture thread keeps only the newest frame, so a slow recognizer makes the
+    pipeline skip frames instead of letting them pile up in the camera driver.
+    `process(frame, seq)` runs on `workers` threads and must be thread safe; seq is
+    the frame's capture index, since workers can finish frames out of order. Its result
+    is handed to `render(frame, result, stats)` on the calling thread (HighGUI
+    windows only work there), which returns False to stop. Results that finish
+    after a newer frame was rendered are dropped so the display never goes back
+    in time. Without `render` the pipeline runs headless.
+
+    `process_every` skips frames at capture: 1 processes every frame, 3 every third.
+    """
+
+    def __init__(self, source, process, render=None, workers=2, process_every=1, max_frames=None):
+        self.source = source
+        self.process = process
+        self.render = render
+        self.workers = max(1, workers)
+        self.process_every = max(1, process_every)
+        self.max_frames = max_frames
+        self.stats = PipelineStats()
+        self.frames = LatestFrame()
+        self.results = queue.Queue(maxsize=self.workers * 2)
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        self.frames.close()
+
+    def _capture(self, capture, live):
+        seq = 0
+        try:
+            while not self.stopped.is_set():
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                seq += 1
+                self.stats.add('captured')
+                if (seq - 1) % self.process_every:
+                    self.stats.add('skipped')
+                    continue
+                # Files and directories have no real-time deadline, so wait for a free worker
+                if self.frames.put((seq, time.perf_counter(), frame), block=not live):
+                    self.stats.add('dropped')
+                if self.max_frames and seq >= self.max_frames:
+                    break
+        finally:
+            capture.release()
+            self.frames.close()
+
+    def _work(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+            seq, captured_at, frame = item
+            try:
+                result = self.process(frame, seq)
+            except Exception as e:
+                print(f"Recognition failed on frame {seq}: {e}")
+                self.stats.add('errors')
+                continue
+            self.stats.record_latency(time.perf_counter() - captured_at)
+            self.results.put((seq, frame, result))
+
+    def run(self):
+        """Run until the source is exhausted or render asks to stop, return the stats"""
+        capture, live = open_source(self.source)
+        if not capture.isOpened():
+            raise RuntimeError(f"Cannot open video source {self.source!r}")
+        self.stats = PipelineStats()
+        threads = [threading.Thread(target=self._capture, args=(capture, live), daemon=True)]
+        threads += [threading.Thread(target=self._work, daemon=True) for _ in range(self.workers)]
+        for t in threads:
+            t.start()
+
+        last_rendered = 0
+        try:
+            while True:
+                try:
+                    seq, frame, result = self.results.get(timeout=0.05)
+                except queue.Empty:
+                    if any(t.is_alive() for t in threads):
+                        continue
+                    # A worker can put its last result just after the timeout and then exit
+                    try:
+                        seq, frame, result = self.results.get_nowait()
+                    except queue.Empty:
+                        break
+                if seq < last_rendered:
+                    self.stats.add('stale')
+                    continue
+                last_rendered = seq
+                self.stats.add('rendered')
+                if self.render and self.render(frame, result, self.stats) is False:
+                    break
+        finally:
+            self.stop()
+            # Unblock workers waiting on a full result queue
+            while any(t.is_alive() for t in threads[1:]):
+                try:
+                    self.results.get(timeout=0.05)
+                except queue.Empty:
+                    pass
+        return self.stats
+
+
+def draw_stats(frame, stats):
+    """Overlay FPS and latency in the top left corner"""
+    text = f"{stats.fps():.1f} fps  {stats.latency_percentile(50):.0f} ms"
+    cv2.putText(frame, text, (10, 25), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 0), 2)